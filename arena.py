@@ -0,0 +1,259 @@
+"""
+Headless agent-vs-agent arena, to generate dialogue corpora.
+
+Two agents picked like in the conversation loop (new_agent over VOICES) talk
+from a seed line for a number of exchanges, each one continuing from the
+other's last words as in MODE 2, with the same hedged generation and context
+window as the spoken sessions. There is no microphone, speech or playback in
+the way, so thousands of conversations run at once on one event loop, up to
+--concurrency of them in flight. Each finished conversation is appended to the
+JSONL output right away.
+
+With --tts every utterance is synthesized afterwards in one batch into the TTS
+cache, and the records carry the cache key of their audio.
+
+    python arena.py --conversations 1000 --exchanges 6 --concurrency 64
+    python arena.py --standins --conversations 5000 --tts
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import time
+from tempfile import gettempdir
+
+from audio_output import PCM_SAMPLE_RATE
+from batching import MicroBatcher
+from context_window import ContextWindow
+from conversation import HEDGE_BACKENDS, VOICES, SharedServices, continue_context, new_agent
+from hedging import HEDGE_ERRORS
+from inference_client import percentile
+from tts_cache import TTSCache
+
+SEEDS = [
+    "Hello, how are you today?",
+    "What do you think about the weather?",
+    "Tell me about your favourite book.",
+    "Where would you go on holiday?",
+    "What is the best way to learn a language?",
+]
+
+
+def pick_agents():
+    first = new_agent(VOICES)
+    return first, new_agent([voice for voice in VOICES if voice != first])
+
+
+class Arena:
+    """
+    :param services: SharedServices, the inference pool and the TTS cache.
+    :param model: The preferred text generation model.
+    :param exchanges: Utterances per conversation.
+    :param concurrency: Conversations in flight at once.
+    :param context_budget: Tokens of each prompt, see ContextWindow.
+    """
+
+    def __init__(self, services, model="gpt2", exchanges=6, concurrency=64, context_budget=256):
+        self.services = services
+        self.model = model
+        self.exchanges = exchanges
+        self.concurrency = concurrency
+        self.context_budget = context_budget
+        self.conversations = 0
+        self.utterances = 0
+        self.failures = 0
+        self.repeats = 0  # utterances saying again what the previous one said
+        self.latencies = []
+
+    async def converse(self, number, seed):
+        agents = pick_agents()
+        context = ContextWindow(self.context_budget)
+        heard, exchanges = seed, []
+        start = time.perf_counter()
+        for turn in range(self.exchanges):
+            agent = agents[turn % 2]
+            prompt, _ = context.prompt(heard, carried=turn > 0)  # past the seed, the other agent's last words
+            begin = time.perf_counter()
+            try:
+                said = await self.services.generate_hedged(prompt, self.model)
+            except HEDGE_ERRORS as error:
+                # every backend failed, the conversation ends here
+                self.failures += 1
+                exchanges.append({"agent": agent, "error": repr(error)})
+                break
+            latency = time.perf_counter() - begin
+            self.latencies.append(latency)
+            if exchanges and exchanges[-1].get("text") == said:
+                self.repeats += 1
+            self.utterances += 1
+            exchanges.append({"agent": agent, "text": said, "latency": round(latency, 4)})
+            if turn == 0:
+                context.add(heard)  # the seed, heard is then the other agent's words, in the window already
+            context.add(said)
+            heard = continue_context(said, heard)
+        self.conversations += 1
+        return {
+            "id": number,
+            "agents": list(agents),
+            "seed": seed,
+            "exchanges": exchanges,
+            "elapsed": round(time.perf_counter() - start, 4),
+        }
+
+    def audio_key(self, agent, text):
+        return self.services.tts_cache.key(agent, self.services.polly_engine, "pcm", PCM_SAMPLE_RATE, text)
+
+    async def run(self, conversations, output, seeds=SEEDS, tts=False):
+        """
+        Runs the conversations and appends them to the output file, a worker per
+        concurrent conversation.
+
+        :return: The (agent, text) of every utterance if tts, for synthesize().
+        """
+        numbers = iter(range(conversations))
+        seeds = itertools.cycle(seeds)
+        utterances = []
+
+        async def worker():
+            for number in numbers:
+                record = await self.converse(number, next(seeds))
+                for exchange in record["exchanges"]:
+                    if tts and "text" in exchange:
+                        exchange["audio"] = self.audio_key(exchange["agent"], exchange["text"])
+                        utterances.append((exchange["agent"], exchange["text"]))
+                output.write(json.dumps(record) + "\n")
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, conversations))))
+        return utterances
+
+    async def synthesize(self, utterances, concurrency=8):
+        """
+        Fills the TTS cache with the utterances, at most concurrency Polly
+        requests at once. Already cached ones cost nothing.
+        """
+        loop = asyncio.get_running_loop()
+        pending = iter(utterances)
+
+        async def worker():
+            for agent, text in pending:
+                chunks = await self.services.synthesize(text, agent)
+                # reading the stream to the end is what stores it in the cache
+                await loop.run_in_executor(None, b"".join, chunks)
+
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, len(utterances)))))
+
+
+def utilization(services, elapsed):
+    """
+    Per backend: requests, failures, and the mean number of requests in flight
+    over the run (launch to end of every request, the hedged and failed ones
+    too, divided by the elapsed time).
+    """
+    return {
+        backend: {
+            "launched": stats.launched,
+            "failures": stats.failures,
+            "in_flight_avg": stats.busy / elapsed if elapsed else None,
+            "latency_p50": percentile(stats.latencies, 50),
+        }
+        for backend, stats in services.hedger.backend_stats.items()
+    }
+
+
+async def run_arena(args):
+    if args.standins:
+        from standins import FakeInference, FakePolly, Latency
+
+        polly, inference = FakePolly(Latency(0.15, 0.3)), FakeInference(Latency(0.6, 1.5), args.capacity)
+    else:
+        from boto3 import Session
+
+        from inference_client import InferenceClient
+
+        polly = Session(profile_name="default").client("polly") if args.tts else None
+        inference = InferenceClient(pool_size=args.concurrency)
+    if args.batch > 1:
+        inference = MicroBatcher(inference, max_batch=args.batch, max_delay=args.batch_delay)
+    # the stand-in silence is kept in memory, out of the cache brain.py plays the real voices from
+    tts_cache = TTSCache() if args.standins else TTSCache(os.path.join(gettempdir(), "polly_cache"))
+    services = SharedServices(polly, inference, tts_cache, backends=args.backends)
+    arena = Arena(services, model=args.model, exchanges=args.exchanges, concurrency=args.concurrency,
+                  context_budget=args.context_budget)
+    seeds = SEEDS
+    if args.seeds:
+        with open(args.seeds) as f:
+            seeds = [line.strip() for line in f if line.strip()]
+
+    warming = asyncio.create_task(services.health.run())
+    try:
+        start = time.perf_counter()
+        with open(args.output, "a") as output:
+            utterances = await arena.run(args.conversations, output, seeds, tts=args.tts)
+        elapsed = time.perf_counter() - start
+        tts_elapsed = None
+        if args.tts:
+            tts_start = time.perf_counter()
+            await arena.synthesize(utterances, args.tts_concurrency)
+            tts_elapsed = time.perf_counter() - tts_start
+    finally:
+        warming.cancel()
+        await services.close()
+
+    return {
+        "conversations": arena.conversations,
+        "utterances": arena.utterances,
+        "failures": arena.failures,
+        "repeats": arena.repeats,
+        "elapsed": elapsed,
+        "conversations_per_s": arena.conversations / elapsed,
+        "utterances_per_s": arena.utterances / elapsed,
+        "latency_p50": percentile(arena.latencies, 50),
+        "latency_p95": percentile(arena.latencies, 95),
+        "backends": utilization(services, elapsed),
+        "inference": services.inference.stats(),
+        "tts_elapsed": tts_elapsed,
+        "tts_cache": services.tts_cache.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--exchanges", type=int, default=6, help="utterances per conversation")
+    parser.add_argument("--concurrency", type=int, default=64, help="conversations in flight at once")
+    parser.add_argument("--model", default="gpt2")
+    parser.add_argument("--backends", nargs="+", default=HEDGE_BACKENDS)
+    parser.add_argument("--context-budget", type=int, default=256)
+    parser.add_argument("--seeds", help="file with one opening line per line")
+    parser.add_argument("--batch", type=int, default=0, help="prompts per batched request, 0 to not batch")
+    parser.add_argument("--batch-delay", type=float, default=0.01, help="seconds a prompt waits for a batch")
+    parser.add_argument("--tts", action="store_true", help="synthesize every utterance once the text is done")
+    parser.add_argument("--tts-concurrency", type=int, default=8)
+    parser.add_argument("--standins", action="store_true", help="local stand-ins instead of the real backends")
+    parser.add_argument("--capacity", type=int, help="requests the stand-in backend serves at once")
+    parser.add_argument("--output", default="dialogues.jsonl")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_arena(args))
+    print(f"{report['conversations']} conversations, {report['utterances']} utterances in "
+          f"{report['elapsed']:.1f} s: {report['conversations_per_s']:.1f} conversations/s, "
+          f"{report['utterances_per_s']:.1f} utterances/s, {report['failures']} failed")
+    if report["repeats"]:
+        print(f"warning: {report['repeats']} utterances repeated the previous one, the agents are not "
+              f"continuing from each other")
+    for backend, stats in report["backends"].items():
+        print(f"{backend:>8}: {stats['launched']} requests, {stats['failures']} failures, "
+              f"{stats['in_flight_avg'] or 0:.1f} in flight on average")
+    if report["inference"].get("batches"):
+        inference = report["inference"]
+        print(f"batches: {inference['batches']}, {inference['batch_size_avg']:.1f} prompts each, "
+              f"queue delay p50 {inference['queue_delay_p50'] * 1000:.0f} ms")
+    if report["tts_elapsed"] is not None:
+        print(f"tts: {report['tts_elapsed']:.1f} s, cache {report['tts_cache']}")
+    print(f"dialogues appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
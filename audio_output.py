@@ -0,0 +1,241 @@
+"""
+Streaming playback of the speech synthesized by Amazon Polly.
+
+Polly is asked for raw 16-bit mono PCM, which needs no decoding, so every chunk
+of the AudioStream can be written to the output device as soon as it arrives
+instead of waiting for the whole reply and going through a temporary mp3 file.
+"""
+
+import asyncio
+import threading
+import time
+import wave
+from contextlib import closing
+
+PCM_SAMPLE_RATE = 16000  # Polly supports "8000" and "16000" for pcm
+PCM_SAMPLE_WIDTH = 2  # int16
+PCM_CHUNK_SIZE = 4096  # bytes, 128 ms of audio at 16 kHz
+
+
+def pcm_chunks(audio_stream, chunk_size=PCM_CHUNK_SIZE):
+    # Yields the Polly AudioStream in chunks as they come from the network.
+    # Closing the stream is important because the service throttles on the
+    # number of parallel connections.
+    with closing(audio_stream) as stream:
+        for chunk in stream.iter_chunks(chunk_size):
+            yield chunk
+
+
+class DeviceSink:
+    """
+    Writes PCM to the default output device through sounddevice.
+
+    The device is opened once and kept running: write() only appends to a buffer
+    that the PortAudio callback drains, so it never blocks, and callers waiting
+    for the end of the audio are notified from the callback instead of polling.
+    monitor, if set, is called from the audio thread with every block the device
+    plays, at the time it is played.
+    """
+
+    def __init__(self, samplerate=PCM_SAMPLE_RATE, blocksize=1024):
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.drained_callbacks = []
+        self.monitor = None
+        self._start(samplerate, blocksize)
+
+    def _start(self, samplerate, blocksize):
+        import sounddevice
+
+        self.stream = sounddevice.RawOutputStream(samplerate=samplerate, channels=1, dtype="int16",
+                                                  blocksize=blocksize, callback=self._callback)
+        self.stream.start()
+
+    def _callback(self, outdata, frame_count, time_info, status):
+        size = len(outdata)
+        with self.lock:
+            played = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            callbacks = []
+            if not self.buffer and self.drained_callbacks:
+                callbacks, self.drained_callbacks = self.drained_callbacks, []
+        outdata[:len(played)] = played
+        outdata[len(played):] = b"\x00" * (size - len(played))  # silence while idle
+        if self.monitor is not None:
+            self.monitor(bytes(outdata))
+        for callback in callbacks:
+            callback()
+
+    def write(self, chunk):
+        with self.lock:
+            self.buffer += chunk
+
+    def on_drained(self, callback):
+        # callback is called from the audio thread once everything written was played
+        with self.lock:
+            if self.buffer:
+                self.drained_callbacks.append(callback)
+                return
+        callback()
+
+    def clear(self):
+        # drops the audio that was not played yet
+        with self.lock:
+            self.buffer.clear()
+            callbacks, self.drained_callbacks = self.drained_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def close(self):
+        self.stream.stop()
+        self.stream.close()
+
+
+class ClockSink(DeviceSink):
+    """
+    Plays nothing but drains the audio at the rate of the device, from a thread
+    standing in for the PortAudio callback. Headless runs then take as long as
+    the speech, so a barge-in cuts the playback short like on a sound card.
+    """
+
+    def _start(self, samplerate, blocksize):
+        self.block_time = blocksize / samplerate
+        self.running = True
+        self.thread = threading.Thread(target=self._run, args=(blocksize,), daemon=True)
+        self.thread.start()
+
+    def _run(self, blocksize):
+        outdata = bytearray(blocksize * PCM_SAMPLE_WIDTH)
+        next_block = time.perf_counter()
+        while self.running:
+            self._callback(outdata, blocksize, None, None)
+            next_block += self.block_time
+            time.sleep(max(0.0, next_block - time.perf_counter()))
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+
+
+class NullSink:
+    """
+    Discards the audio. Used to run the pipeline headless, the audio counts as
+    played, and is passed to monitor, as soon as it is written.
+    """
+
+    def __init__(self):
+        self.bytes_written = 0
+        self.monitor = None
+
+    def write(self, chunk):
+        self.bytes_written += len(chunk)
+        if self.monitor is not None:
+            self.monitor(chunk)
+
+    def on_drained(self, callback):
+        callback()
+
+    def clear(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FileSink(NullSink):
+    """
+    Appends the audio to a wav file instead of playing it.
+    """
+
+    def __init__(self, path, samplerate=PCM_SAMPLE_RATE):
+        super().__init__()
+        self.file = wave.open(path, "wb")
+        self.file.setnchannels(1)
+        self.file.setsampwidth(PCM_SAMPLE_WIDTH)
+        self.file.setframerate(samplerate)
+
+    def write(self, chunk):
+        super().write(chunk)
+        self.file.writeframes(chunk)
+
+    def close(self):
+        self.file.close()
+
+
+def play_pcm_stream(chunks, sink, start=None, stopped=None):
+    """
+    Feeds the PCM chunks to the sink as they are produced.
+
+    :param chunks: An iterable of raw int16 PCM bytes.
+    :param sink: An object with a write(bytes) method.
+    :param start: The perf_counter() time the synthesis was requested. Defaults
+                  to the moment this function is called.
+    :param stopped: A threading.Event, once set the rest of the chunks is dropped.
+    :return: The time to first audio in seconds, or None if nothing was played.
+    """
+    start = time.perf_counter() if start is None else start
+    first_audio = None
+    remainder = b""
+    for chunk in chunks:
+        if stopped is not None and stopped.is_set():
+            if hasattr(chunks, "close"):
+                chunks.close()  # releases the Polly connection
+            break
+        # the network may split a sample in two, keep the odd byte for later
+        chunk = remainder + chunk
+        cut = len(chunk) - len(chunk) % PCM_SAMPLE_WIDTH
+        chunk, remainder = chunk[:cut], chunk[cut:]
+        if not chunk:
+            continue
+        sink.write(chunk)
+        if first_audio is None:
+            first_audio = time.perf_counter() - start
+    return first_audio
+
+
+class AudioOutput:
+    """
+    Asynchronous audio output engine. The sink stays open across turns and
+    play() runs the network reads in a worker thread and then waits on a future
+    resolved by the sink, so the event loop keeps running during playback.
+    """
+
+    def __init__(self, sink=None):
+        self.sink = DeviceSink() if sink is None else sink
+        self.playing = set()  # the stop events of the play() calls in progress
+
+    async def play(self, chunks, start=None):
+        """
+        Plays the PCM chunks and returns once they have been heard.
+
+        :return: The time to first audio in seconds, or None if nothing was played.
+        """
+        loop = asyncio.get_running_loop()
+        stopped = threading.Event()
+        self.playing.add(stopped)
+        try:
+            first_audio = await loop.run_in_executor(None, play_pcm_stream, chunks, self.sink, start, stopped)
+            done = loop.create_future()
+
+            def set_done():
+                if not done.done():
+                    done.set_result(None)
+
+            self.sink.on_drained(lambda: loop.call_soon_threadsafe(set_done))
+            await done
+        except asyncio.CancelledError:
+            stopped.set()  # the worker thread stops writing at the next chunk
+            raise
+        finally:
+            self.playing.discard(stopped)
+        return first_audio
+
+    def stop(self):
+        # silences whatever is still queued, the pending play() calls return right away; every play()
+        # on this output is stopped, sessions that must not cut each other off need an output each
+        for stopped in self.playing:
+            stopped.set()
+        self.sink.clear()
+
+    def close(self):
+        self.sink.close()
@@ -0,0 +1,270 @@
+"""
+Where the user's voice comes from.
+
+Every source yields (audio_chunk, status) tuples of 16 kHz mono int16 PCM, the
+way mic_stream always did, so they all feed the same path to Transcribe:
+
+- MicrophoneSource: the sound card, through sounddevice.
+- WavFileSource: replays a recording, in real time or faster (speed=None is as
+  fast as possible), to drive the pipeline on a server or in a benchmark.
+- TcpSource / PipeSource: raw PCM streamed by a remote client or another process.
+
+While an agent speaks the session calls pause() and the source gates its
+blocks in software instead of stopping the device:
+
+- "mute": the blocks are replaced by silence, Transcribe keeps receiving audio
+  so it does not close the stream after 15 s without any.
+- "half_duplex": the blocks are dropped.
+- "pass": the blocks go through, for barge-in.
+"""
+
+import asyncio
+import os
+import sys
+import time
+import wave
+
+from ring_buffer import RingBuffer
+
+SAMPLE_RATE = 16000
+BLOCK_SIZE = 1024 * 2  # samples per chunk, like the microphone blocks
+SAMPLE_WIDTH = 2
+GATES = ("mute", "half_duplex", "pass")
+
+
+class AudioSource:
+    """
+    Base class, subclasses implement blocks(). pause() and resume() are called
+    around the agent speaking and close or open the gate.
+
+    :param gate: "mute", "half_duplex" or "pass", what the closed gate does.
+    """
+
+    def __init__(self, gate="pass"):
+        if gate not in GATES:
+            raise ValueError(f"gate must be one of {GATES}, not {gate!r}")
+        self.gate = gate
+        self.gated = False
+        self.gated_blocks = 0
+        self.silence = b""
+        self.monitor = None  # called with every block that reaches the closed gate
+
+    def __aiter__(self):
+        return self.gated_stream()
+
+    async def blocks(self):
+        raise NotImplementedError
+        yield
+
+    async def gated_stream(self):
+        async for block, status in self.blocks():
+            if self.gated and self.monitor is not None:
+                self.monitor(block)  # may open the gate, this block then goes through
+            if self.gated and self.gate != "pass":
+                self.gated_blocks += 1
+                if self.gate == "half_duplex":
+                    continue
+                if len(self.silence) < len(block):
+                    self.silence = bytes(len(block))
+                block = memoryview(self.silence)[:len(block)]
+            yield block, status
+
+    def pause(self):
+        self.gated = True
+
+    def resume(self):
+        self.gated = False
+
+    def stats(self):
+        return {"gated_blocks": self.gated_blocks}
+
+
+class MicrophoneSource(AudioSource):
+    """
+    The blocks are captured into a RingBuffer and yielded as memoryviews, each
+    one valid until the next block is requested. The device is opened once and
+    stays open for the whole session, the agent speaking only closes the gate.
+
+    :param buffer_blocks: Blocks the capture ring holds, 64 is ~8 s of audio.
+    :param policy: What to do when the consumer falls behind, see ring_buffer.py.
+    """
+
+    def __init__(self, samplerate=SAMPLE_RATE, blocksize=BLOCK_SIZE, buffer_blocks=64, policy="drop_oldest",
+                 gate="mute"):
+        super().__init__(gate)
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self.stream = None
+        self.ring = RingBuffer(blocksize * SAMPLE_WIDTH, buffer_blocks, policy)
+        self.device_open = None  # seconds it took to open and start the device
+
+    async def blocks(self):
+        # This function wraps the raw input stream from the microphone forwarding
+        # the blocks through the capture ring.
+        import sounddevice
+
+        self.ring.attach(asyncio.get_running_loop())
+
+        def callback(indata, frame_count, time_info, status):
+            self.ring.write(indata, status)
+
+        # Be sure to use the correct parameters for the audio stream that matches
+        # the audio formats described for the source language you'll be using:
+        # https://docs.aws.amazon.com/transcribe/latest/dg/streaming.html
+        start = time.perf_counter()
+        self.stream = sounddevice.RawInputStream(
+            channels=1,
+            samplerate=self.samplerate,
+            callback=callback,
+            blocksize=self.blocksize,
+            dtype="int16",
+        )
+
+        # Initiate the audio stream and asynchronously yield the audio chunks
+        # as they become available.
+        with self.stream:
+            self.device_open = time.perf_counter() - start
+            while True:
+                indata, status = await self.ring.read()
+                yield indata, status
+
+    def stats(self):
+        return {**super().stats(), "device_open": self.device_open, "capture": self.ring.stats()}
+
+
+def measure_device_open(repeats=10, samplerate=SAMPLE_RATE, blocksize=BLOCK_SIZE):
+    """
+    Seconds to open, start, stop and close the default input device, the cost
+    every turn used to pay before the gate.
+    """
+    import sounddevice
+
+    costs = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with sounddevice.RawInputStream(channels=1, samplerate=samplerate, blocksize=blocksize, dtype="int16"):
+            pass
+        costs.append(time.perf_counter() - start)
+    return costs
+
+
+class WavFileSource(AudioSource):
+    """
+    :param path: A 16 kHz, 16-bit mono wav file.
+    :param speed: Multiple of real time the blocks are yielded at, None for as
+                  fast as possible.
+    :param repeat: Start over at the end of the file instead of stopping.
+    """
+
+    def __init__(self, path, speed=1.0, repeat=False, blocksize=BLOCK_SIZE, gate="pass"):
+        super().__init__(gate)
+        self.path = path
+        self.speed = speed
+        self.repeat = repeat
+        self.blocksize = blocksize
+        with wave.open(path, "rb") as f:
+            if (f.getframerate(), f.getsampwidth(), f.getnchannels()) != (SAMPLE_RATE, SAMPLE_WIDTH, 1):
+                raise ValueError(f"{path}: expected {SAMPLE_RATE} Hz 16-bit mono audio")
+
+    async def blocks(self):
+        block_time = self.blocksize / SAMPLE_RATE
+        start = time.perf_counter()
+        sent = 0
+        while True:
+            with wave.open(self.path, "rb") as f:
+                while True:
+                    block = f.readframes(self.blocksize)
+                    if not block:
+                        break
+                    if self.speed is None:
+                        await asyncio.sleep(0)  # let the rest of the loop run
+                    else:
+                        # paced on the start time so the delays do not add up
+                        sent += 1
+                        await asyncio.sleep(max(0.0, start + sent * block_time / self.speed - time.perf_counter()))
+                    yield block, None
+            if not self.repeat:
+                break
+
+
+class StreamSource(AudioSource):
+    """
+    Base of the sources reading raw int16 PCM from an asyncio StreamReader.
+    """
+
+    def __init__(self, blocksize=BLOCK_SIZE, gate="pass"):
+        super().__init__(gate)
+        self.block_bytes = blocksize * SAMPLE_WIDTH
+
+    async def open(self):
+        raise NotImplementedError
+
+    async def blocks(self):
+        reader = await self.open()
+        while True:
+            try:
+                block = await reader.readexactly(self.block_bytes)
+            except asyncio.IncompleteReadError as end:
+                block = end.partial[:len(end.partial) - len(end.partial) % SAMPLE_WIDTH]
+                if block:
+                    yield block, None
+                break
+            yield block, None
+
+
+class TcpSource(StreamSource):
+    """
+    Listens on host:port and yields the PCM sent by the first client.
+    """
+
+    def __init__(self, host="0.0.0.0", port=5005, **kwargs):
+        super().__init__(**kwargs)
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def open(self):
+        connected = asyncio.get_running_loop().create_future()
+
+        def on_client(reader, writer):
+            if not connected.done():
+                connected.set_result(reader)
+
+        self.server = await asyncio.start_server(on_client, self.host, self.port)
+        try:
+            return await connected
+        finally:
+            self.server.close()  # one client per source, the connection stays open
+
+
+class PipeSource(StreamSource):
+    """
+    Reads PCM from a named pipe, a file, or standard input with path "-".
+    """
+
+    def __init__(self, path="-", **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        if self.path == "-":
+            pipe = sys.stdin.buffer
+        else:
+            # opening a named pipe blocks until a writer connects, the other sessions keep running
+            pipe = await loop.run_in_executor(None, open, self.path, "rb")
+        reader = asyncio.StreamReader()
+        if os.path.isfile(self.path):
+            # regular files can not be watched by the event loop, they are fed at once
+            reader.feed_data(await loop.run_in_executor(None, pipe.read))
+            reader.feed_eof()
+            pipe.close()
+            return reader
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        return reader
+
+
+if __name__ == "__main__":
+    costs = measure_device_open()
+    print(f"input device open/close: avg {sum(costs) / len(costs) * 1000:.1f} ms, "
+          f"max {max(costs) * 1000:.1f} ms over {len(costs)} opens")
@@ -0,0 +1,136 @@
+"""
+Health of the text generation backends.
+
+The HuggingFace endpoint answers with a "model is loading" payload until the
+model is warm, which used to surface as an error in the middle of a live
+turn. Every backend is warmed up in the background at startup and probed
+periodically afterwards. A circuit breaker per backend opens after repeated
+failures or slow answers, so live turns are routed straight to the healthy
+ones, and lets a single trial request through once its cool down has passed.
+"""
+
+import asyncio
+import time
+
+from hedging import HEDGE_ERRORS
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitBreaker:
+    """
+    :param failure_threshold: Consecutive failures that open the circuit.
+    :param slow_threshold: Answers slower than this many seconds count as failures.
+    :param reset_timeout: Seconds the circuit stays open before a trial request.
+    """
+
+    def __init__(self, failure_threshold=3, slow_threshold=10.0, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.slow_threshold = slow_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+
+    def allow(self):
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            return True
+        return self.state == CLOSED
+
+    def record_success(self, latency):
+        if latency > self.slow_threshold:
+            self.record_failure()
+            return
+        self.state = CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.times_opened += 1
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+
+class BackendHealth:
+    """
+    :param generate: Coroutine function (context, model) returning the reply text.
+    :param backends: Models to keep warm.
+    :param probe_interval: Seconds between readiness probes once warm.
+    :param warm_up_attempts: Probes per backend before giving up the warm-up.
+    """
+
+    def __init__(self, generate, backends, probe_interval=60.0, probe_text="Hello,",
+                 warm_up_attempts=10, warm_up_delay=5.0, **breaker_kwargs):
+        self.generate = generate
+        self.backends = list(backends)
+        self.probe_interval = probe_interval
+        self.probe_text = probe_text
+        self.warm_up_attempts = warm_up_attempts
+        self.warm_up_delay = warm_up_delay
+        self.breakers = {backend: CircuitBreaker(**breaker_kwargs) for backend in self.backends}
+        self.ready = set()
+        self.probes = 0
+
+    async def tracked(self, context, backend):
+        # drop-in replacement of generate that feeds the breakers with the live traffic
+        start = time.perf_counter()
+        try:
+            reply = await self.generate(context, backend)
+        except HEDGE_ERRORS:
+            self.record_failure(backend)
+            raise
+        self.record_success(backend, time.perf_counter() - start)
+        return reply
+
+    def record_success(self, backend, latency):
+        # also for the requests that do not go through tracked, e.g. streamed replies
+        breaker = self.breakers.get(backend)  # None for a backend that is not kept warm
+        if breaker is not None:
+            breaker.record_success(latency)
+        self.ready.add(backend)
+
+    def record_failure(self, backend):
+        breaker = self.breakers.get(backend)
+        if breaker is not None:
+            breaker.record_failure()
+
+    async def probe(self, backend):
+        self.probes += 1
+        try:
+            await self.tracked(self.probe_text, backend)
+            return True
+        except HEDGE_ERRORS:
+            return False
+
+    async def warm_up(self, backend):
+        for _ in range(self.warm_up_attempts):
+            if await self.probe(backend):
+                return True
+            await asyncio.sleep(self.warm_up_delay)  # the model is still loading
+        return False
+
+    async def run(self):
+        # warms every backend in parallel, then keeps probing them
+        await asyncio.gather(*(self.warm_up(backend) for backend in self.backends))
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            await asyncio.gather(*(self.probe(backend) for backend in self.backends))
+
+    def route(self, backends):
+        """
+        Keeps the order of preference but only the warm backends whose circuit
+        is closed. Falls back to the given list when none of them is healthy.
+        """
+        healthy = [backend for backend in backends
+                   if backend not in self.breakers or (backend in self.ready and self.breakers[backend].allow())]
+        return healthy or list(backends)
+
+    def stats(self):
+        return {
+            backend: {"ready": backend in self.ready, "state": breaker.state, "opened": breaker.times_opened}
+            for backend, breaker in self.breakers.items()
+        }
@@ -0,0 +1,100 @@
+"""
+Barge-in detection: the user talking over the agent.
+
+While an agent speaks the microphone blocks are checked for the user's voice.
+What the microphone picks up of the agent's own voice is estimated from the
+level of the audio being played and an echo coupling (how much quieter the
+speaker is at the microphone), which is learnt while nobody interrupts. The
+level is taken from what the output device is playing, not from the audio as it
+downloads, so the estimate follows what the microphone actually picks up. A
+frame is the user when it is louder than that echo estimate by margin_db; a
+run of min_speech of them is a barge-in.
+
+The blocks seen before the barge-in are kept, so the session can send the
+first syllables of the interruption to Transcribe even though they arrived
+while the microphone was gated.
+"""
+
+import collections
+import time
+
+import numpy as np
+
+from audio_sources import BLOCK_SIZE
+from endpointing import FRAME_SIZE, frame_features
+
+
+class BargeInDetector:
+    """
+    :param min_speech: Seconds of consecutive user frames that interrupt the agent.
+    :param margin_db: How far over the echo estimate a frame must be to be the user.
+    :param coupling_db: Initial level of the echo relative to the played audio.
+    :param min_energy_db: Frames quieter than this are never the user.
+    :param preroll: Seconds of audio kept from before the barge-in.
+    """
+
+    def __init__(self, sample_rate=16000, min_speech=0.15, margin_db=10.0, coupling_db=-20.0,
+                 min_energy_db=-45.0, preroll=0.5, frame_size=FRAME_SIZE, block_size=BLOCK_SIZE):
+        self.frame_time = frame_size / sample_rate
+        self.frame_size = frame_size
+        self.min_speech = min_speech
+        self.margin_db = margin_db
+        self.coupling_db = coupling_db
+        self.min_energy_db = min_energy_db
+        self.preroll = collections.deque(maxlen=max(1, int(preroll * sample_rate / block_size)))
+        self.playback_db = -120.0
+        self.detected_at = None  # perf_counter() when the barge-in was detected
+        self.onset = None  # perf_counter() when the user started talking over the agent
+        self.reset()
+
+    def reset(self):
+        # called when the agent starts speaking
+        self.speech_run = 0.0
+        self.fired = False
+        self.preroll.clear()
+
+    def on_playback(self, chunk):
+        # level of the agent's voice, from the audio the sink is playing (its monitor)
+        samples = np.frombuffer(chunk, dtype=np.int16)
+        usable = samples.size - samples.size % self.frame_size
+        if usable:
+            energy_db, _ = frame_features(samples[:usable], self.frame_size)
+            self.playback_db += 0.5 * (float(energy_db.max()) - self.playback_db)
+
+    def process(self, block):
+        """
+        Feeds one microphone block heard while the agent speaks.
+
+        :return: True once, when the user starts talking over the agent.
+        """
+        if self.fired:
+            return False
+        samples = np.frombuffer(block, dtype=np.int16)
+        usable = samples.size - samples.size % self.frame_size
+        if not usable:
+            return False
+        energy_db, _ = frame_features(samples[:usable], self.frame_size)
+        echo_db = self.playback_db + self.coupling_db
+        threshold = max(echo_db + self.margin_db, self.min_energy_db)
+        for frame_db in energy_db:
+            if frame_db > threshold:
+                self.speech_run += self.frame_time
+                if self.speech_run >= self.min_speech:
+                    self.fired = True
+                    self.detected_at = time.perf_counter()
+                    self.onset = self.detected_at - self.speech_run
+                    return True
+            else:
+                self.speech_run = 0.0
+                if frame_db > self.min_energy_db:
+                    # only the echo is heard: the coupling rises fast and decays slowly
+                    coupling = float(frame_db) - self.playback_db
+                    rate = 0.2 if coupling > self.coupling_db else 0.01
+                    self.coupling_db += rate * (coupling - self.coupling_db)
+        self.preroll.append(bytes(block))
+        return False
+
+    def take_preroll(self):
+        blocks = list(self.preroll)
+        self.preroll.clear()
+        return blocks
@@ -0,0 +1,124 @@
+"""
+Cross-session micro-batching of the text generation requests.
+
+With many sessions on one process every turn used to be its own small request.
+MicroBatcher sits in front of the inference client with the same query()
+interface: the prompts of concurrent callers for the same model and parameters
+are held for at most max_delay, or until max_batch of them are waiting, and go
+out as one request with a list of inputs. The answer list is fanned back out,
+each caller gets the body a request of its own would have returned.
+
+Models that do not take a list of inputs are passed straight through.
+"""
+
+import asyncio
+import json
+import time
+
+from inference_client import InferenceError, percentile
+
+
+class _Batch:
+    def __init__(self):
+        self.inputs = []
+        self.futures = []
+        self.queued = []  # perf_counter() of every enqueue
+        self.timeout = None
+        self.timer = None
+
+
+class MicroBatcher:
+    """
+    :param inference: The InferenceClient (or stand-in) the batches are sent with.
+    :param max_batch: Prompts per request at most.
+    :param max_delay: Seconds the first prompt of a batch waits for others.
+    :param models: Models accepting a list of inputs, None for all of them.
+    """
+
+    def __init__(self, inference, max_batch=8, max_delay=0.01, models=None):
+        self.inference = inference
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.models = models
+        self.pending = {}  # (model, parameters) -> the _Batch being filled
+        self.batches = 0
+        self.batched = 0
+        self.batch_sizes = {}  # size -> number of batches
+        self.queue_delays = []
+
+    async def query(self, model, payload, timeout=None):
+        if self.models is not None and model not in self.models or isinstance(payload.get("inputs"), list):
+            return await self.inference.query(model, payload, timeout)
+        parameters = {key: value for key, value in payload.items() if key != "inputs"}
+        key = (model, json.dumps(parameters, sort_keys=True))
+        batch = self.pending.get(key)
+        if batch is None:
+            batch = self.pending[key] = _Batch()
+            batch.timer = asyncio.get_running_loop().call_later(self.max_delay, self._flush, key, batch)
+        future = asyncio.get_running_loop().create_future()
+        batch.inputs.append(payload["inputs"])
+        batch.futures.append(future)
+        batch.queued.append(time.perf_counter())
+        if timeout is not None:
+            batch.timeout = timeout if batch.timeout is None else min(batch.timeout, timeout)
+        if len(batch.inputs) >= self.max_batch:
+            batch.timer.cancel()
+            self._flush(key, batch)
+        return await future
+
+    def _flush(self, key, batch):
+        if self.pending.get(key) is batch:
+            del self.pending[key]
+        # callers cancelled meanwhile, e.g. a hedged request that lost, are left out
+        live = [ix for ix, future in enumerate(batch.futures) if not future.done()]
+        if not live:
+            return
+        batch.inputs = [batch.inputs[ix] for ix in live]
+        batch.futures = [batch.futures[ix] for ix in live]
+        now = time.perf_counter()
+        self.queue_delays.extend(now - batch.queued[ix] for ix in live)
+        asyncio.ensure_future(self._send(key[0], json.loads(key[1]), batch))
+
+    async def _send(self, model, parameters, batch):
+        size = len(batch.inputs)
+        self.batches += 1
+        self.batched += size
+        self.batch_sizes[size] = self.batch_sizes.get(size, 0) + 1
+        try:
+            if size == 1:
+                bodies = [await self.inference.query(model, {"inputs": batch.inputs[0], **parameters},
+                                                     batch.timeout)]
+            else:
+                body = await self.inference.query(model, {"inputs": batch.inputs, **parameters}, batch.timeout)
+                if isinstance(body, list) and len(body) == size:
+                    bodies = body
+                elif isinstance(body, dict):
+                    bodies = [body] * size  # an error payload is everyone's
+                else:
+                    raise InferenceError(f"{model}: {size} inputs, unexpected answer {str(body)[:80]}")
+        except Exception as error:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for future, body in zip(batch.futures, bodies):
+            if not future.done():
+                future.set_result(body)
+
+    def stream(self, model, payload, timeout=None):
+        # tokens are per caller, streams are not batched
+        return self.inference.stream(model, payload, timeout)
+
+    def stats(self):
+        return {
+            **self.inference.stats(),
+            "batches": self.batches,
+            "batched_prompts": self.batched,
+            "batch_size_avg": self.batched / self.batches if self.batches else None,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "queue_delay_p50": percentile(self.queue_delays, 50),
+            "queue_delay_p95": percentile(self.queue_delays, 95),
+        }
+
+    async def close(self):
+        await self.inference.close()
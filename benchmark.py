@@ -0,0 +1,208 @@
+"""
+End to end latency benchmark of the voice loop, with local stand-ins for
+Transcribe, Polly and the inference API (see standins.py).
+
+The conversation loop is driven from a recording (or a synthetic utterance)
+in real time, and for every turn the time between these moments is measured:
+
+- endpoint: the user stops talking -> the end of the turn is detected
+- llm: end of the turn -> the reply text is ready
+- tts: reply ready -> first audio sample written to the output
+- end_to_end: the user stops talking -> first audio sample
+
+p50/p95/p99 of each stage are printed and written as json so regressions can
+be tracked:
+
+    python benchmark.py --turns 20 --llm 0.6,1.5 --polly 0.15,0.3 --output bench.json
+    python benchmark.py --wav recording.wav --text "what I say in it" --http
+"""
+
+import argparse
+import asyncio
+import json
+import socket
+import time
+
+from audio_output import AudioOutput, ClockSink, NullSink
+from audio_sources import WavFileSource
+from batching import MicroBatcher
+from conversation import HEDGE_BACKENDS, ConversationSession, SharedServices, run_sessions
+from fillers import Fillers
+from generation_budget import GenerationBudget
+from inference_client import InferenceClient, InferenceRouter, percentile
+from standins import FakeInference, FakePolly, FakeTranscribeClient, Latency, SyntheticSource, inference_app
+from tracing import NULL_TRACER, Tracer
+from tts_cache import TTSCache
+
+STAGES = {
+    "endpoint": ("speech_end", "endpoint"),
+    "llm": ("endpoint", "reply_ready"),
+    "tts": ("reply_ready", "first_audio"),
+    "end_to_end": ("speech_end", "first_audio"),
+}
+
+
+def parse_latency(value):
+    # "median" or "median,p95" in seconds
+    parts = [float(part) for part in value.split(",")]
+    return Latency(*parts)
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+    }
+
+
+def stage_latencies(turn_timings):
+    stages = {stage: [] for stage in STAGES}
+    for timing in turn_timings:
+        for stage, (begin, end) in STAGES.items():
+            if timing.get(begin) is not None and timing.get(end) is not None:
+                stages[stage].append(timing[end] - timing[begin])
+    return stages
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def run_benchmark(args):
+    runner = None
+    if args.http:
+        # the real InferenceClient, talking HTTP to a local stand-in server
+        from aiohttp import web
+
+        runner = web.AppRunner(inference_app(args.llm))
+        await runner.setup()
+        port = free_port()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        inference = InferenceClient(base_url=f"http://127.0.0.1:{port}", token="")
+    else:
+        inference = FakeInference(args.llm, args.capacity, args.token_time)
+    backends = HEDGE_BACKENDS
+    if args.local:
+        # the in-process model answers the sessions, the stand-in stays as the fallback
+        from local_inference import LocalInference
+
+        inference = InferenceRouter(inference, {args.local: LocalInference([args.local])})
+        backends = [args.local] + HEDGE_BACKENDS
+    if args.batch > 1:
+        inference = MicroBatcher(inference, max_batch=args.batch, max_delay=args.batch_delay)
+    tracer = Tracer(args.trace) if args.trace else NULL_TRACER
+    services = SharedServices(FakePolly(args.polly), inference, TTSCache(memory_bytes=0 if args.no_cache else 2 ** 25),
+                              backends=backends, tracer=tracer, generation=GenerationBudget(args.turn_target),
+                              fillers=Fillers(threshold=args.fillers) if args.fillers is not None else None)
+
+    sessions = []
+    for _ in range(args.sessions):
+        if args.wav:
+            source = WavFileSource(args.wav, speed=1.0, repeat=True)
+        else:
+            source = SyntheticSource(speed=1.0, speech=args.speech, pause=args.pause)
+        sessions.append(ConversationSession(
+            # its own, a barge-in stops only this session; the replies must take their time to be talked over
+            services, AudioOutput(ClockSink() if args.barge_in else NullSink()), source=source,
+            transcribe_client_factory=lambda: FakeTranscribeClient(args.text, result_latency=args.transcribe),
+            model=args.local or "gpt2", mode=1, streaming=args.streaming,
+            chunk_time_size=args.speech + args.pause + 1, quiet=True,
+            name=f"session-{len(sessions)}", barge_in=args.barge_in, suppress_silence=args.suppress_silence))
+
+    start = time.perf_counter()
+    try:
+        await run_sessions(services, sessions, turns=args.turns)
+    finally:
+        await services.close()
+        for session in sessions:
+            session.output.close()
+        tracer.close()
+        if runner is not None:
+            await runner.cleanup()
+    elapsed = time.perf_counter() - start
+
+    stages = {stage: [] for stage in STAGES}
+    for session in sessions:
+        for stage, values in stage_latencies(session.turn_timings).items():
+            stages[stage] += values
+    return {
+        "config": {key: {"median": value.median, "sigma": value.sigma} if isinstance(value, Latency) else value
+                   for key, value in vars(args).items()},
+        "elapsed": elapsed,
+        "turns": sum(session.turns for session in sessions),
+        "stages": {stage: summarize(values) for stage, values in stages.items()},
+        "interrupt_to_silence": summarize([latency for session in sessions
+                                           for latency in session.interrupt_latencies]),
+        "upstream": [session.transcription.upstream.stats() for session in sessions],
+        "speculation_hits": sum(session.speculator.hits for session in sessions),
+        "tts_cache": services.tts_cache.stats(),
+        "inference": services.inference.stats(),
+        "generation": services.generation.stats(),
+        "fillers": services.fillers.stats() if services.fillers is not None else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--wav", help="16 kHz mono recording to replay, a synthetic utterance by default")
+    parser.add_argument("--text", default="hello there how are you doing today",
+                        help="what the stand-in transcription hears")
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--sessions", type=int, default=1)
+    parser.add_argument("--speech", type=float, default=1.5, help="seconds of synthetic speech per turn")
+    parser.add_argument("--pause", type=float, default=3.0, help="seconds of silence after it")
+    parser.add_argument("--llm", type=parse_latency, default=Latency(0.6, 1.5), help="median[,p95] seconds")
+    parser.add_argument("--polly", type=parse_latency, default=Latency(0.15, 0.3), help="median[,p95] seconds")
+    parser.add_argument("--transcribe", type=parse_latency, default=Latency(0.2, 0.4),
+                        help="median[,p95] seconds from audio to transcript")
+    parser.add_argument("--http", action="store_true", help="serve the stand-in LLM over HTTP")
+    parser.add_argument("--local", help="in-process model instead of the stand-in LLM, e.g. local:distilgpt2")
+    parser.add_argument("--streaming", action="store_true", help="stream the LLM tokens into the speech")
+    parser.add_argument("--batch", type=int, default=0, help="prompts per batched LLM request, 0 to not batch")
+    parser.add_argument("--batch-delay", type=float, default=0.01, help="seconds a prompt waits for a batch")
+    parser.add_argument("--capacity", type=int, help="requests the stand-in LLM serves at once")
+    parser.add_argument("--token-time", type=float, default=0.0, help="seconds per word the stand-in LLM generates")
+    parser.add_argument("--turn-target", type=float, default=2.0,
+                        help="seconds from the end of speech to the first audio the replies are sized for")
+    parser.add_argument("--no-cache", action="store_true", help="keep the TTS cache out of the way")
+    parser.add_argument("--barge-in", action="store_true",
+                        help="let the user interrupt the agent, --pause shorter than the reply to exercise it")
+    parser.add_argument("--suppress-silence", action="store_true",
+                        help="leave the long silences out of the transcription stream")
+    parser.add_argument("--fillers", type=float, metavar="THRESHOLD",
+                        help="play a filler when the reply is not ready this many seconds after the endpoint")
+    parser.add_argument("--trace", help="append the per-turn spans to this JSONL file")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmark(args))
+    for stage, summary in results["stages"].items():
+        if summary["count"]:
+            print(f"{stage:>10}: p50 {summary['p50'] * 1000:7.0f} ms  p95 {summary['p95'] * 1000:7.0f} ms  "
+                  f"p99 {summary['p99'] * 1000:7.0f} ms  ({summary['count']} turns)")
+    interrupts = results["interrupt_to_silence"]
+    if interrupts["count"]:
+        print(f"barge-in to silence: p50 {interrupts['p50'] * 1000:.0f} ms  p95 {interrupts['p95'] * 1000:.0f} ms  "
+              f"({interrupts['count']} interruptions)")
+    for model, stats in results["generation"].items():
+        if isinstance(stats, dict):
+            print(f"{model:>10}: {stats['tokens_per_s']:.0f} tokens/s, {stats['overhead'] * 1000:.0f} ms overhead, "
+                  f"max_new_tokens {stats['max_new_tokens']}")
+    fillers = results["fillers"]
+    if fillers is not None:
+        print(f"fillers: fired {fillers['fired']} of {fillers['turns']} turns, hid "
+              f"p50 {(fillers['hidden_p50'] or 0) * 1000:.0f} ms of silence, {fillers['hidden_total']:.1f} s in total")
+    upstream = results["upstream"]
+    print(f"upstream: {sum(stats['kbit_per_s'] or 0 for stats in upstream) / len(upstream):.1f} kbit/s per session")
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Token-budgeted conversation context.
+
+The prompt is the latest words plus as much of the conversation as fits in the
+budget: the newest turns verbatim, and a rolling summary of the older ones.
+Each turn is counted once when it is added and the running totals are kept up
+to date, so a long session never re-tokenizes its history. When the turns no
+longer fit the oldest one is compacted into the summary, which keeps the first
+sentence of every compacted turn and forgets the oldest of them past its own
+budget. The prompt size, and with it the inference latency, stays bounded
+however long the conversation goes.
+"""
+
+import collections
+import re
+
+from speech_pipeline import split_sentences
+
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+
+def count_tokens(text):
+    """
+    Approximates the GPT-2 BPE count: one token per word or punctuation mark,
+    plus one for every 8 letters of a long word.
+    """
+    return sum(1 + (len(piece) - 1) // 8 for piece in _TOKEN.findall(text))
+
+
+def clip_tokens(text, budget, tokenize=count_tokens):
+    # the last words of text that fit in budget tokens
+    words = text.split()
+    kept, used = [], 0
+    for word in reversed(words):
+        used += tokenize(word)
+        if used > budget:
+            break
+        kept.append(word)
+    return " ".join(reversed(kept))
+
+
+class ContextWindow:
+    """
+    :param budget: Tokens the whole prompt may take.
+    :param reserve: Tokens kept free for the latest words when compacting.
+    :param summary_budget: Tokens the summary of the old turns may take.
+    :param summary_sentence: Tokens kept of each compacted turn.
+    :param tokenize: Callable counting the tokens of a text, e.g. the length of
+                     a HuggingFace tokenizer's encode(). Approximated by default.
+    """
+
+    def __init__(self, budget=256, reserve=64, summary_budget=64, summary_sentence=24, tokenize=count_tokens):
+        self.budget = budget
+        self.reserve = reserve
+        self.summary_budget = summary_budget
+        self.summary_sentence = summary_sentence
+        self.tokenize = tokenize
+        self.turns = collections.deque()  # (text, tokens), oldest first
+        self.turn_tokens = 0
+        self.summary = collections.deque()  # (sentence, tokens) of the compacted turns
+        self.summary_tokens = 0
+        self.compacted = 0
+        self.prompts = 0
+        self.prompt_tokens = 0  # of the latest prompt
+        self.prompt_tokens_total = 0
+        self.prompt_tokens_max = 0
+
+    @property
+    def last_text(self):
+        return self.turns[-1][0] if self.turns else ""
+
+    def add(self, text):
+        """
+        Appends a turn, compacting the oldest ones if the window overflows.
+        """
+        text = text.strip()
+        if not text:
+            return
+        tokens = self.tokenize(text) + 1  # and the line break joining it
+        self.turns.append((text, tokens))
+        self.turn_tokens += tokens
+        while len(self.turns) > 1 and self.turn_tokens + self.summary_tokens > self.budget - self.reserve:
+            self._compact()
+
+    def _compact(self):
+        text, tokens = self.turns.popleft()
+        self.turn_tokens -= tokens
+        self.compacted += 1
+        sentences = split_sentences(text)
+        sentence = clip_tokens(sentences[0] if sentences else text, self.summary_sentence, self.tokenize)
+        if not sentence:
+            return
+        tokens = self.tokenize(sentence) + 1
+        self.summary.append((sentence, tokens))
+        self.summary_tokens += tokens
+        while self.summary_tokens > self.summary_budget:
+            _, tokens = self.summary.popleft()
+            self.summary_tokens -= tokens
+
+    def prompt(self, text, carried=False):
+        """
+        :param carried: text is the end of the last turn, an agent carrying on
+                        from the previous reply. The history is then the prompt,
+                        the words are not repeated.
+        :return: (prompt, history), the prompt ends with text and starts with the
+                 history that fits in the budget.
+        """
+        repeated = (carried and bool(text.strip()) and self.last_text.endswith(text.strip())
+                    and self.turns[-1][1] <= self.budget)
+        tokens = 0 if repeated else self.tokenize(text)
+        if tokens > self.budget:
+            text = clip_tokens(text, self.budget, self.tokenize)
+            tokens = self.tokenize(text)
+        room = self.budget - tokens
+        lines = []
+        for turn, turn_tokens in reversed(self.turns):
+            if turn_tokens > room:
+                break
+            lines.append(turn)
+            room -= turn_tokens
+        if self.summary and self.summary_tokens <= room and len(lines) == len(self.turns):
+            lines.append(" ".join(sentence for sentence, _ in self.summary))
+            room -= self.summary_tokens
+        history = "".join(line + "\n" for line in reversed(lines))
+        self.prompt_tokens = self.budget - room
+        self.prompts += 1
+        self.prompt_tokens_total += self.prompt_tokens
+        self.prompt_tokens_max = max(self.prompt_tokens_max, self.prompt_tokens)
+        return (history[:-1] if repeated else history + text), history
+
+    def stats(self):
+        return {
+            "turns": len(self.turns),
+            "compacted": self.compacted,
+            "summary_tokens": self.summary_tokens,
+            "prompt_tokens_avg": self.prompt_tokens_total / self.prompts if self.prompts else None,
+            "prompt_tokens_max": self.prompt_tokens_max,
+        }
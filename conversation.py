@@ -0,0 +1,609 @@
+"""
+The hearing -> thinking -> speaking loop of one conversation.
+
+Everything a conversation needs to remember (what was heard and said, which
+agent is talking, whether it is speaking, its microphone) lives in a
+ConversationSession, so a single event loop can host many conversations at
+once. The expensive parts, the inference connection pool, the TTS cache and the
+backend health, are in SharedServices and used by every session.
+"""
+
+import asyncio
+import functools
+import random
+import time
+
+from amazon_transcribe.handlers import TranscriptResultStreamHandler
+from amazon_transcribe.model import TranscriptEvent
+from botocore.exceptions import BotoCoreError, ClientError
+
+from audio_output import PCM_SAMPLE_RATE, pcm_chunks
+from audio_sources import MicrophoneSource
+from backend_health import BackendHealth
+from barge_in import BargeInDetector
+from context_window import ContextWindow, count_tokens
+from endpointing import Endpointer
+from generation_budget import GenerationBudget, until_stop
+from hedging import HEDGE_ERRORS, Hedger
+from inference_client import generated_text
+from speculation import Speculator, normalize
+from speech_pipeline import sentence_stream, speak, split_sentences
+from tracing import NULL_TRACER, NULL_TURN
+from transcription import TranscriptionSession
+from upstream_audio import UpstreamAudio
+
+VOICES = ["Nicole", "Russell", "Amy", "Emma", "Brian", "Aditi", "Raveena", "Ivy",
+          "Joanna", "Kendra", "Kimberly", "Salli", "Joey", "Justin", "Matthew", "Geraint"]
+COLOR_CHOICE = [1, 0, 1, 1, 0, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0]
+AGENTS_COLOR = {f"{name}": COLOR_CHOICE[ix] for ix, name in enumerate(VOICES)}
+
+AGENT1_COLOR = '\033[96m'  # cyan
+AGENT2_COLOR = '\033[95m'  # magenta
+END_COLOR = '\033[0m'
+
+HEDGE_BACKENDS = ["gpt2", "bloom"]
+POLLY_ENGINE = "standard"
+
+
+def new_agent(li=VOICES):
+    return random.choice(li)
+
+
+def agent_color(agent):
+    return AGENT1_COLOR if AGENTS_COLOR[agent] == 0 else AGENT2_COLOR
+
+
+def continue_context(said, heard):
+    # the next agent continues from the last words of the previous one
+    punkt = said.rfind(".")
+    if punkt == -1:
+        # print("punkt-1")
+        punkt = len(said)//2
+    # print(f"_p{punkt}|l{len(said)}")
+    if punkt + 1 != len(said):
+        return said[punkt + 1:]
+    # the replies are trimmed to a full stop, there is no unfinished tail to carry on
+    sentences = split_sentences(said)
+    return sentences[-1] if sentences else heard
+
+
+async def print_transcript(result):
+    if result[-1] == ".":
+        print(f"\r[hearing]... {result}", end="", flush=True)
+
+
+class SharedServices:
+    """
+    What every session of the process shares.
+
+    :param polly: A boto3 Polly client.
+    :param inference: An InferenceClient, its connection pool is used by all sessions.
+    :param tts_cache: A TTSCache.
+    :param backends: The text generation models that are raced and kept warm.
+    :param tracer: The Tracer the turns are recorded with, disabled by default.
+    :param generation: The GenerationBudget sizing the replies, a 2 s turn target by default.
+    :param fillers: The Fillers played while a reply is late, None for silence.
+    """
+
+    def __init__(self, polly, inference, tts_cache, backends=HEDGE_BACKENDS, polly_engine=POLLY_ENGINE,
+                 tracer=NULL_TRACER, generation=None, fillers=None):
+        self.polly = polly
+        self.fillers = fillers
+        self.tracer = tracer
+        self.generation = GenerationBudget() if generation is None else generation
+        self.inference = inference
+        self.tts_cache = tts_cache
+        self.backends = list(backends)
+        self.polly_engine = polly_engine
+        self.health = BackendHealth(self.generate_text, self.backends)
+        self.hedger = Hedger(self.health.tracked, self.backends)
+
+    async def generate_text(self, context, model="bloom"):
+        # awaited on the shared connection pool, the event loop keeps forwarding the microphone meanwhile
+        start = time.perf_counter()
+        reply = await self.inference.query(model, {"inputs": f"{context}",
+                                                   "parameters": self.generation.parameters(model)})
+        latency = time.perf_counter() - start
+        self.tracer.observe("inference", latency, model=model)
+        # gpt2 answers [{...}], bloom [[{...}]], a batched prompt one level less
+        text = generated_text(reply)
+        self.generation.observe(model, count_tokens(text), latency)
+        # backends ignoring return_full_text or stop still echo the prompt or run on
+        return self.generation.trim(context, text)
+
+    def route(self, model):
+        # model first then the other backends, those with an open circuit left out
+        return self.health.route([model] + [backend for backend in self.backends if backend != model])
+
+    async def generate_hedged(self, context, model):
+        # the other backends join the race if model is slow or fails
+        return await self.hedger.generate_hedged(context, self.route(model))
+
+    async def synthesize(self, text, voice):
+        key = self.tts_cache.key(voice, self.polly_engine, "pcm", PCM_SAMPLE_RATE, text)
+        audio = self.tts_cache.get(key)
+        self.tracer.count("tts_requests", cached=audio is not None)
+        if audio is not None:
+            # said before, no need to ask Polly again
+            return [audio]
+
+        try:
+            # Request speech synthesis as raw PCM so it can be played while it downloads
+            response = await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self.polly.synthesize_speech, Text=text, OutputFormat="pcm",
+                                        Engine=self.polly_engine, SampleRate=str(PCM_SAMPLE_RATE), VoiceId=voice))
+        except (BotoCoreError, ClientError) as error:
+            # The service returned an error, this sentence is not said but the other sessions go on
+            print(error)
+            return []
+
+        # Access the audio stream from the response
+        if "AudioStream" not in response:
+            print("Could not stream audio")
+            return []
+        return self.tts_cache.tee(key, pcm_chunks(response["AudioStream"]))
+
+    def stats(self):
+        return {
+            "inference": self.inference.stats(),
+            "tts_cache": self.tts_cache.stats(),
+            "hedging": self.hedger.stats(),
+            "backends": self.health.stats(),
+            "generation": self.generation.stats(),
+            "fillers": self.fillers.stats() if self.fillers is not None else None,
+        }
+
+    async def close(self):
+        await self.inference.close()
+
+
+class SessionEventHandler(TranscriptResultStreamHandler):
+    def __init__(self, transcript_result_stream, session):
+        super().__init__(transcript_result_stream)
+        self.session = session
+
+    async def handle_transcript_event(self, transcript_event: TranscriptEvent):
+        results = transcript_event.transcript.results
+
+        for result in results:
+            self.session.services.tracer.count("transcript_results", partial=bool(result.is_partial))
+            self.session.endpointer.on_transcript(result.is_partial)
+            for alt in result.alternatives:
+                self.session.hear(alt.transcript)
+
+
+class ConversationSession:
+    """
+    One conversation: what it hears goes to the language model and the reply
+    is spoken by a random agent.
+
+    :param services: The SharedServices of the process.
+    :param output: The AudioOutput the agents speak on.
+    :param source: The AudioSource the user is heard from. Defaults to the microphone.
+    :param transcribe_client_factory: Callable returning a TranscribeStreamingClient.
+    :param model: The preferred text generation model.
+    :param mode: 1: agents do not hear each other; if user does not say no more then last_heard is never
+                 overwriten. 2: agents hear each other last words and the user, and continue from it the context.
+    :param streaming: Speak the reply sentence by sentence while the model streams its tokens.
+    :param quiet: Do not print the conversation, for when many sessions share the console.
+    :param name: Identifies the session in the traces.
+    :param barge_in: Stop the agent as soon as the user talks over it.
+    :param upstream_encoding: "pcm", "flac" or "ogg-opus", how the audio is sent to Transcribe.
+    :param suppress_silence: Leave most of the long silences out of the Transcribe stream.
+    :param context_budget: Tokens of conversation history and latest words the prompts may take.
+    """
+
+    def __init__(self, services, output, source=None, transcribe_client_factory=None, model="gpt2", mode=2,
+                 streaming=False, chunk_time_size=6, number_of_lines=100, verbose=False, quiet=False, name="",
+                 barge_in=False, upstream_encoding="pcm", suppress_silence=False,
+                 context_budget=256):
+        self.services = services
+        self.tracer = services.tracer
+        self.name = name
+        self.output = output
+        self.source = MicrophoneSource() if source is None else source
+        self.transcribe_client_factory = transcribe_client_factory
+        self.upstream_encoding = upstream_encoding
+        self.suppress_silence = suppress_silence
+        self.model = model
+        self.mode = mode
+        self.streaming = streaming
+        self.chunk_time_size = chunk_time_size
+        self.number_of_lines = number_of_lines
+        self.verbose = verbose
+        self.quiet = quiet
+
+        self.last_heard = ""
+        self.heard_fresh = False  # last_heard holds words of the user not added to the context yet
+        self.carried = False  # last_heard holds the end of the last reply, carried on in MODE 2
+        self.answered = None  # normalized words of the user the last turn answered
+        self.last_said = ""
+        self.agent = ""
+        self.speaking = False
+        self.turns = 0
+        self.time_to_first_audio = []  # seconds from the Polly request to the first sample written to the sink
+        self.timing = {}
+        self.turn = NULL_TURN  # the spans of the current turn
+        self.context = ContextWindow(context_budget)  # what the agents remember of the conversation
+        self.turn_timings = []  # perf_counter() of speech_end, endpoint, reply_ready, first_audio, playback_end
+        self.endpointer = Endpointer()  # ends the turn when the user stops talking
+        self.speculator = Speculator(self.speculate_reply)  # starts the LLM request on stable partial transcripts
+        self.transcription = None
+
+        self.barge_in = None
+        self.playback = None  # the task speaking the current reply
+        self.interrupted = False
+        self.preroll = []  # blocks of the barge-in heard before the gate opened
+        self.interrupt_latencies = []  # seconds from the user talking over the agent to silence
+        self.masking = None  # the task playing a filler if the reply is late
+        self.thinking = None  # the task waiting for the reply text, while a filler may be playing
+        self.filler = None  # the FillerPlayback of the current turn
+        if barge_in:
+            self.barge_in = BargeInDetector()
+            self.source.monitor = self.on_gated_block
+            # the level of the agent's voice as it is played tells its echo from the user
+            self.output.sink.monitor = self.barge_in.on_playback
+
+    def log(self, *args, **kwargs):
+        if not self.quiet:
+            print(*args, **kwargs)
+
+    def hear(self, transcript):
+        if transcript and normalize(transcript) == self.answered:
+            # the final result of a turn already answered, the endpoint came before it
+            if not self.carried:
+                self.last_heard = transcript
+            return
+        if transcript:
+            self.answered = None
+        self.last_heard = transcript
+        self.heard_fresh = bool(transcript)
+        self.carried = False
+        if not self.speaking:
+            self.speculator.on_transcript(transcript)
+        if not self.quiet and transcript:
+            asyncio.ensure_future(print_transcript(transcript))
+
+    async def speculate_reply(self, context):
+        prompt, _ = self.context.prompt(context, self.carried)
+        return await self.services.generate_hedged(prompt, self.model)
+
+    def remember(self, heard, said, fresh):
+        # heard is added only when it was new words of the user, not the agents' own words carried on
+        # in MODE 2 (in the window already) nor the same words answered again on a turn nobody talked
+        if heard and fresh:
+            self.context.add(heard)
+        self.context.add(said)
+
+    async def synthesize(self, text):
+        self.stop_masking()  # the reply is on its way, no filler if none is playing yet
+        start = time.perf_counter()
+        chunks = await self.services.synthesize(text, self.agent)
+        self.turn.span("tts_request", start, time.perf_counter(), voice=self.agent, chars=len(text))
+        if self.filler is not None and not self.filler.handed_over:
+            chunks = self.filler.take_over(chunks)
+        return chunks
+
+    def start_masking(self):
+        fillers = self.services.fillers
+        self.filler = None
+        if fillers is not None:
+            fillers.turns += 1
+            self.masking = asyncio.ensure_future(self.mask_latency(fillers))
+
+    def stop_masking(self):
+        if self.masking is not None and self.filler is None:
+            self.masking.cancel()
+        self.masking = None
+
+    async def mask_latency(self, fillers):
+        # the reply is late: the agent acknowledges the user until its first audio takes over
+        await asyncio.sleep(fillers.threshold)
+        self.filler = fillers.playback(self.agent, self.output)
+        if self.filler is None:
+            return  # not synthesized yet
+        self.pause_hearing()
+        self.tracer.count("fillers", voice=self.agent)
+        if self.verbose:
+            self.log("[filler]...")
+        await self.filler.play()
+
+    def pause_hearing(self):
+        if self.barge_in is not None:
+            self.barge_in.reset()
+        self.source.pause()
+
+    def resume_hearing(self):
+        self.source.resume()
+
+    def on_gated_block(self, block):
+        # a microphone block heard while the agent speaks
+        if self.barge_in.process(block):
+            self.interrupt()
+
+    def interrupt(self):
+        # the user talks over the agent: silence it, drop the rest of the reply and listen
+        self.interrupted = True
+        self.resume_hearing()
+        self.endpointer.reset()  # the new turn starts with the words that interrupted
+        self.preroll = self.barge_in.take_preroll()
+        self.speculator.cancel()
+        if self.playback is not None:
+            self.playback.cancel()  # synthesis and the streamed inference with it
+        if self.thinking is not None:
+            self.thinking.cancel()  # only a filler was playing, the reply is not wanted anymore
+        self.output.stop()
+        silenced = time.perf_counter()
+        self.interrupt_latencies.append(silenced - self.barge_in.onset)
+        self.turn.span("barge_in", self.barge_in.onset, silenced, agent=self.agent)
+        self.tracer.count("barge_ins")
+        self.log("\n[interrupted]...")
+
+    async def read_outloud(self, text):
+        # text is the whole reply, or an async iterator of sentences when the reply is streamed
+        # the agent should not hear itself, the microphone stays open but is gated while it speaks
+        self.pause_hearing()
+
+        self.log(f"------------- said by: {agent_color(self.agent) + self.agent + END_COLOR}")
+
+        # The first sentence is played while it downloads and the next ones are synthesized
+        # during playback. Other coroutines keep running until the output engine is done.
+        start = time.perf_counter()
+        try:
+            sentences = split_sentences(text) if isinstance(text, str) else text
+            self.playback = asyncio.ensure_future(speak(sentences, self.synthesize, self.output, start=start))
+            first_audio = await self.playback
+        except asyncio.CancelledError:
+            if not self.interrupted:
+                raise
+            first_audio = None
+        finally:
+            self.stop_masking()  # nothing was said
+            self.playback = None
+            self.resume_hearing()
+        self.timing["playback_end"] = time.perf_counter()
+        if first_audio is not None:
+            self.timing["first_audio"] = start + first_audio
+            self.turn.span("first_audio", self.timing["first_audio"])
+            if self.filler is not None and self.filler.handed_over:
+                # heard from the filler on instead of silence
+                self.services.fillers.hidden.append(self.timing["first_audio"] - self.filler.started_at)
+                self.turn.span("filler", self.filler.started_at, self.timing["first_audio"])
+            self.turn.span("playback", self.timing["first_audio"], self.timing["playback_end"])
+            self.turn.span("end_to_end", self.timing.get("speech_end"), self.timing["first_audio"])
+            self.time_to_first_audio.append(first_audio)
+            self.services.generation.observe_tts(first_audio)
+            if self.verbose:
+                self.log(f"[first audio]... {first_audio * 1000:.0f} ms")
+
+    async def new_line(self):
+        for _ in range(self.number_of_lines):
+            await asyncio.sleep(self.chunk_time_size)
+            self.log()
+
+    async def reply(self):
+        # reply as soon as the user stops talking, or after chunk_time_size if nobody talks
+        if not self.interrupted:
+            self.endpointer.reset()  # after a barge-in it is already following the user
+        self.interrupted = False
+        await self.endpointer.wait(self.chunk_time_size)
+        self.timing = {"speech_end": self.endpointer.speech_ended_at, "endpoint": self.endpointer.endpointed_at}
+        self.turn_timings.append(self.timing)
+        self.turn = self.tracer.start_turn(self.name)
+        self.turn.span("capture", self.endpointer.speech_started_at, self.endpointer.speech_ended_at)
+        self.turn.span("endpoint", self.endpointer.speech_ended_at, self.endpointer.endpointed_at)
+
+        if self.verbose:
+            self.log(f"[processing]... {self.last_heard}")
+        heard, fresh = self.last_heard, self.heard_fresh
+        self.heard_fresh = False  # words heard from now on belong to the next turn
+        if fresh:
+            self.answered = normalize(heard)
+
+        if self.last_heard and self.streaming and not self.speculator.matches(self.last_heard):
+            # nothing speculated for these words, the reply is streamed instead
+            self.speculator.cancel()
+            self.speaking = True
+            self.agent = new_agent(VOICES)
+            self.start_masking()
+            try:
+                self.last_said = await self.stream_reply(self.last_heard)
+            except HEDGE_ERRORS:
+                # the stream failed before its first sentence, the whole reply is asked for instead
+                if self.verbose:
+                    self.log("[gpt2]...")
+                prompt, _ = self.context.prompt(self.last_heard, self.carried)
+                try:
+                    self.thinking = asyncio.ensure_future(self.services.generate_hedged(prompt, "gpt2"))
+                    self.last_said = await self.thinking
+                except HEDGE_ERRORS as error:
+                    if self.verbose:
+                        self.log(f"[no reply]... {error!r}")
+                    self.last_said = ""
+                except asyncio.CancelledError:
+                    if not self.interrupted:
+                        raise
+                    self.last_said = ""  # the user talked over the filler
+                finally:
+                    self.thinking = None
+                if self.interrupted:
+                    self.stop_masking()
+                else:
+                    await self.read_outloud(self.last_said)
+            self.speaking = False
+            self.remember(heard, self.last_said, fresh)
+            if self.mode == 2 and not self.interrupted:
+                self.carry_on()
+
+        elif self.last_heard:
+            # in streaming mode too when the reply was speculated, it is whole already
+            self.speaking = True
+            self.agent = new_agent(VOICES)
+            self.start_masking()
+            start_color = agent_color(self.agent)
+            try:
+                try:
+                    if self.verbose:
+                        self.log(f"[{self.model}]...")
+                    # reuses the request started while the user was still talking if the words match
+                    start, hits = time.perf_counter(), self.speculator.hits
+                    self.thinking = asyncio.ensure_future(self.speculator.result(self.last_heard))
+                    self.last_said = await self.thinking
+                    self.timing["reply_ready"] = time.perf_counter()
+                    self.turn.span("llm_request", start, self.timing["reply_ready"], model=self.model,
+                                   speculated=self.speculator.hits > hits, prompt_tokens=self.context.prompt_tokens)
+
+                except HEDGE_ERRORS as error:
+                    # every backend failed (the fallback models were already raced), nothing to say this turn
+                    if self.verbose:
+                        self.log(f"[no reply]... {error!r}")
+                    self.last_said = ""
+
+                except asyncio.CancelledError:
+                    if not self.interrupted:
+                        raise
+                    self.last_said = ""  # the user talked over the filler and has the floor
+
+                finally:
+                    self.thinking = None
+
+                if not self.interrupted:
+                    self.log(f"[speaking]... {start_color + self.last_said + END_COLOR}")
+                    await self.read_outloud(self.last_said)
+                self.remember(heard, self.last_said, fresh)
+                if self.mode == 2 and not self.interrupted:
+                    # the user who interrupted has the floor, the agents do not continue
+                    self.carry_on()
+
+            finally:
+                # a turn cancelled or failed midway says and remembers nothing
+                self.speaking = False
+                self.stop_masking()
+
+    def carry_on(self):
+        # MODE 2: the next agent continues from the last words said, not from words of the user
+        self.last_heard = continue_context(self.last_said, self.last_heard)
+        self.heard_fresh = False
+        self.carried = True
+
+    async def stream_reply(self, context):
+        # Speaks the reply while the model streams it, each sentence goes to Polly as soon as it is complete.
+        start_color = agent_color(self.agent)
+        spoken = []
+
+        async def sentences():
+            if self.verbose:
+                self.log(f"[{self.model} streaming]...")
+            prompt, _ = self.context.prompt(context, self.carried)
+            generation, health = self.services.generation, self.services.health
+            model = self.services.route(self.model)[0]  # a stream is not hedged, the healthiest backend takes it
+            tokens = self.services.inference.stream(model, {"inputs": prompt,
+                                                            "parameters": generation.parameters(model)})
+            start = time.perf_counter()
+            try:
+                # paced by the playback, a streamed reply tells nothing of the backend's rate
+                async for sentence in sentence_stream(until_stop(tokens, generation.stop)):
+                    if "reply_ready" not in self.timing:
+                        self.timing["reply_ready"] = time.perf_counter()
+                        self.turn.span("llm_first_sentence", start, self.timing["reply_ready"], model=model)
+                        health.record_success(model, self.timing["reply_ready"] - start)
+                    self.log(f"[speaking]... {start_color + sentence + END_COLOR}")
+                    spoken.append(sentence)
+                    yield sentence
+            except HEDGE_ERRORS:
+                health.record_failure(model)
+                raise
+            if "reply_ready" not in self.timing:
+                health.record_success(model, time.perf_counter() - start)  # answered, with nothing to say
+            self.turn.span("llm_request", start, time.perf_counter(), model=model, streamed=True,
+                           prompt_tokens=self.context.prompt_tokens)
+
+        try:
+            await self.read_outloud(sentences())
+        except HEDGE_ERRORS:
+            if not spoken:
+                raise  # nothing was said, the caller asks another way
+            # the stream broke off mid-reply: what was said stands, nothing is said twice
+            if self.verbose:
+                self.log("[stream cut]...")
+        return " ".join(spoken)
+
+    async def audio_chunks(self):
+        # every block goes through the endpointer on its way to Transcribe, except
+        # while the agent speaks: muted blocks would drag the noise floor down
+        async for indata, status in self.source:
+            self.tracer.count("audio_blocks")
+            if self.preroll:
+                # the start of a barge-in, heard while the gate was still closed
+                preroll, self.preroll = self.preroll, []
+                for block in preroll:
+                    self.endpointer.process(block)
+                    yield block, None
+            if not self.source.gated:
+                self.endpointer.process(indata)
+            yield indata, status
+
+    async def run(self, turns=None):
+        """
+        Runs the conversation for the given number of turns, forever if None.
+        """
+        # one transcription stream for the whole conversation, the turns are cut by reply()
+        handler_class = functools.partial(SessionEventHandler, session=self)
+        upstream = UpstreamAudio(self.upstream_encoding, self.suppress_silence)
+        self.transcription = TranscriptionSession(handler_class, self.audio_chunks(),
+                                                  client_factory=self.transcribe_client_factory,
+                                                  upstream=upstream)
+        hearing = asyncio.create_task(self.transcription.run())  # writes on last_heard
+        try:
+            while turns is None or self.turns < turns:
+                lines = asyncio.create_task(self.new_line())
+                try:
+                    await self.reply()
+                finally:
+                    lines.cancel()
+                self.turns += 1
+                if hearing.done():
+                    hearing.result()  # the transcription stopped, its error ends the session
+                self.tracer.flush()
+                self.log("")
+                if self.verbose:
+                    self.log(f"[transcription]... {self.transcription.stats()}")
+        finally:
+            await self.transcription.close()
+            hearing.cancel()
+
+    def stats(self):
+        return {
+            "turns": self.turns,
+            "time_to_first_audio": self.time_to_first_audio,
+            "speculation": self.speculator.stats(),
+            "transcription": self.transcription.stats() if self.transcription else None,
+            "context": self.context.stats(),
+            "source": self.source.stats(),
+            "barge_in": {
+                "interruptions": len(self.interrupt_latencies),
+                "interrupt_to_silence_avg": (sum(self.interrupt_latencies) / len(self.interrupt_latencies)
+                                             if self.interrupt_latencies else None),
+            },
+        }
+
+
+async def run_sessions(services, sessions, turns=None, metrics_port=None):
+    """
+    Runs the sessions side by side on the current event loop. The backends are
+    warmed up and the fillers synthesized in the background while the users say
+    their first words.
+    """
+    background = [asyncio.create_task(services.health.run())]
+    if services.fillers is not None:
+        background.append(asyncio.create_task(services.fillers.load(services.synthesize, VOICES)))
+    if metrics_port is not None:
+        background.append(asyncio.create_task(services.tracer.serve_metrics(port=metrics_port)))
+    running = [asyncio.create_task(session.run(turns)) for session in sessions]
+    try:
+        await asyncio.gather(*running)
+    finally:
+        # a session that failed leaves no other one running on the services the caller closes next
+        for task in running + background:
+            task.cancel()
+        await asyncio.gather(*running, *background, return_exceptions=True)
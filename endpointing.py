@@ -0,0 +1,243 @@
+"""
+End-of-turn detection on the microphone blocks.
+
+Every int16 block coming from mic_stream is split in short frames and the frame
+energy and zero-crossing rate are computed with NumPy in one go. A frame is
+speech when it is loud enough over the adaptive noise floor and does not look
+like broadband noise. The turn ends once the user has been quiet for the
+hangover time, or for the shorter final_hangover when Transcribe has already
+marked the last result as final, instead of always waiting CHUNK_TIME_SIZE.
+A noise that starts while the user talks (a fan, a TV) is loud enough to pass
+for speech, so the floor also follows the energy when it has stayed steady for
+a second, and a turn never lasts longer than max_turn.
+
+Run it on recordings to check the endpoint timing:
+
+    python endpointing.py recording.wav [expected_end_s ...] [--tolerance s]
+
+It fails when an endpoint is missing, unexpected, or off by more than the
+tolerance.
+"""
+
+import asyncio
+import collections
+import sys
+import time
+import wave
+
+import numpy as np
+
+FRAME_SIZE = 256  # samples, 16 ms at 16 kHz; mic_stream blocks hold 8 frames
+FULL_SCALE_DB = 20 * np.log10(32768)
+
+
+def frame_features(samples, frame_size=FRAME_SIZE):
+    """
+    :param samples: int16 samples, a multiple of frame_size long.
+    :return: Energy in dBFS and zero-crossing rate of every frame.
+    """
+    frames = samples.reshape(-1, frame_size).astype(np.float32)
+    energy_db = 10 * np.log10(np.mean(frames * frames, axis=1) + 1e-9) - FULL_SCALE_DB
+    signs = np.signbit(frames)
+    zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+    return energy_db, zcr
+
+
+class Endpointer:
+    """
+    :param hangover: Seconds of silence after speech that end the turn.
+    :param final_hangover: Seconds of silence that end the turn once Transcribe
+                           reported a final (not partial) result.
+    :param min_speech: Seconds of consecutive speech frames needed to consider
+                       that the user started talking.
+    :param margin_db: How far over the noise floor a frame must be to be speech.
+    :param zcr_max: Frames crossing zero more often than this are taken as noise
+                    unless they are very loud.
+    :param stationary_db: Frames whose energy varied less than this over the last
+                          second are background noise, even over the threshold.
+    :param max_turn: Seconds after the user started talking the turn ends anyway.
+    """
+
+    def __init__(self, sample_rate=16000, hangover=0.7, final_hangover=0.3, min_speech=0.1,
+                 margin_db=10.0, zcr_max=0.35, min_energy_db=-55.0, stationary_db=3.0, max_turn=30.0,
+                 frame_size=FRAME_SIZE):
+        self.sample_rate = sample_rate
+        self.hangover = hangover
+        self.final_hangover = final_hangover
+        self.min_speech = min_speech
+        self.margin_db = margin_db
+        self.zcr_max = zcr_max
+        self.min_energy_db = min_energy_db
+        self.frame_size = frame_size
+        self.frame_time = frame_size / sample_rate
+        self.stationary_db = stationary_db
+        self.max_turn = max_turn
+        self.recent_db = collections.deque(maxlen=int(sample_rate / frame_size))  # the last second of frames
+        self.noise_db = -60.0
+        self.remainder = np.zeros(0, dtype=np.int16)
+        self.time = 0.0  # seconds of audio processed, so file replays are deterministic
+        self.endpoint = asyncio.Event()
+        self.endpoints = []  # stream time of every endpoint fired
+        self.reset()
+
+    def reset(self):
+        # called at the start of every turn
+        self.speech_run = 0.0
+        self.speech_seen = False
+        self.silence = 0.0
+        self.final = False
+        self.speech_started_at = None  # perf_counter() when the user started talking
+        self.speech_ended_at = None  # perf_counter() when the user stopped talking
+        self.endpointed_at = None  # perf_counter() when the end of the turn was detected
+        self.endpoint.clear()
+
+    def process(self, block):
+        """
+        Feeds one block of int16 PCM bytes.
+
+        :return: True if the end of the turn was detected in this block.
+        """
+        samples = np.frombuffer(block, dtype=np.int16)
+        if self.remainder.size:
+            samples = np.concatenate((self.remainder, samples))
+        usable = samples.size - samples.size % self.frame_size
+        self.remainder = samples[usable:]
+        if not usable:
+            return False
+        energy_db, zcr = frame_features(samples[:usable], self.frame_size)
+
+        threshold = max(self.noise_db + self.margin_db, self.min_energy_db)
+        speech = (energy_db > threshold) & ((zcr < self.zcr_max) | (energy_db > threshold + self.margin_db))
+        quiet = energy_db[~speech]
+        if quiet.size:
+            # the floor follows the background slowly, rising slower than it falls
+            rate = 0.05 if quiet.mean() > self.noise_db else 0.3
+            self.noise_db += rate * (float(quiet.mean()) - self.noise_db)
+        self.recent_db.extend(energy_db.tolist())
+        if len(self.recent_db) == self.recent_db.maxlen and np.std(self.recent_db) < self.stationary_db:
+            # speech comes and goes with the syllables, a steady level over the floor is a new background
+            level = float(np.mean(self.recent_db))
+            if level > self.noise_db:
+                self.noise_db += 0.05 * (level - self.noise_db)
+
+        fired = False
+        for is_speech in speech:
+            self.time += self.frame_time
+            if is_speech:
+                self.speech_run += self.frame_time
+                if self.speech_run >= self.min_speech:
+                    if not self.speech_seen:
+                        self.speech_started_at = time.perf_counter() - self.speech_run
+                    self.speech_seen = True
+                    self.silence = 0.0
+                    self.final = False
+            else:
+                self.speech_run = 0.0
+                self.silence += self.frame_time
+                fired = self.check() or fired  # frame accurate endpoint time
+        if fired:
+            # the block arrives when its last sample was captured, the speech ended one trailing silence before
+            self.speech_ended_at = self.endpointed_at - self.silence
+        return fired
+
+    def on_transcript(self, is_partial):
+        # Transcribe result flags, a final result lets the turn end sooner
+        self.final = not is_partial
+        self.check()
+
+    def check(self):
+        if self.endpoint.is_set() or not self.speech_seen:
+            return False
+        if self.silence >= (self.final_hangover if self.final else self.hangover):
+            self.endpoints.append(self.time)
+            self.endpointed_at = time.perf_counter()
+            self.speech_ended_at = self.endpointed_at - self.silence
+            self.endpoint.set()
+            return True
+        return False
+
+    async def wait(self, timeout):
+        """
+        Waits for the end of the turn. The timeout only applies while nobody is
+        talking, a user in the middle of a sentence is only cut off after max_turn.
+
+        :return: True on an endpoint, False if nobody spoke within the timeout.
+        """
+        while True:
+            if self.speech_seen:
+                left = self.speech_started_at + self.max_turn - time.perf_counter()
+                if left <= 0:
+                    self.cut()
+                    return True
+                wait = min(timeout, left)
+            else:
+                wait = timeout
+            try:
+                await asyncio.wait_for(self.endpoint.wait(), wait)
+                return True
+            except asyncio.TimeoutError:
+                if not self.speech_seen:
+                    return False
+
+    def cut(self):
+        # the turn went on for max_turn, it ends here whatever is still heard
+        self.endpoints.append(self.time)
+        self.endpointed_at = self.speech_ended_at = time.perf_counter()
+        self.endpoint.set()
+
+
+def replay(path, block_size=2048, **kwargs):
+    """
+    Feeds a 16-bit mono wav file to an Endpointer block by block, the same way
+    mic_stream does, and returns the stream times of the endpoints.
+    """
+    with wave.open(path, "rb") as f:
+        if f.getsampwidth() != 2 or f.getnchannels() != 1:
+            raise ValueError(f"{path}: expected 16-bit mono audio")
+        endpointer = Endpointer(sample_rate=f.getframerate(), **kwargs)
+        while True:
+            block = f.readframes(block_size)
+            if not block:
+                break
+            if endpointer.process(block):
+                endpointer.reset()  # next turn
+    return endpointer.endpoints
+
+
+def timing_errors(endpoints, expected, tolerance):
+    """
+    :return: A line per endpoint that is missing, unexpected or further than
+             tolerance seconds from the expected time, empty if all are on time.
+    """
+    errors = []
+    for ix in range(max(len(endpoints), len(expected))):
+        if ix >= len(endpoints):
+            errors.append(f"endpoint {ix}: missed (expected {expected[ix]:.3f} s)")
+        elif ix >= len(expected):
+            errors.append(f"endpoint {ix}: {endpoints[ix]:.3f} s not expected")
+        elif abs(endpoints[ix] - expected[ix]) > tolerance:
+            errors.append(f"endpoint {ix}: {endpoints[ix]:.3f} s, {endpoints[ix] - expected[ix]:+.3f} s "
+                          f"off the expected {expected[ix]:.3f} s")
+    return errors
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Replays a recording through the Endpointer.")
+    parser.add_argument("path", help="16-bit mono wav")
+    parser.add_argument("expected", nargs="*", type=float, help="expected endpoint times in seconds")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="seconds an endpoint may be off")
+    args = parser.parse_args()
+
+    endpoints = replay(args.path)
+    for ix, end in enumerate(endpoints):
+        line = f"endpoint {ix}: {end:.3f} s"
+        if ix < len(args.expected):
+            line += f" (expected {args.expected[ix]:.3f} s, error {end - args.expected[ix]:+.3f} s)"
+        print(line)
+    if args.expected:
+        errors = timing_errors(endpoints, args.expected, args.tolerance)
+        for error in errors:
+            print(error)
+        sys.exit(1 if errors else 0)
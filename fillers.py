@@ -0,0 +1,172 @@
+"""
+Fillers: a short acknowledgement while the reply is being prepared.
+
+Between the end of the user's turn and the first audio of the reply there are
+the LLM request and the first Polly request, a second or more of silence. A few
+short phrases ("Hmm.", "Let me think.") are synthesized for every voice at
+startup and kept in memory. When the reply is still not ready threshold seconds
+after the endpoint, one is played right away in the voice of the agent about to
+answer. When the reply's first audio comes it takes over with a cross-fade:
+what is left of the filler fades out under the fade-in of the reply.
+
+The filler is written to the sink in real time, a couple of frames ahead of
+what is heard, so that only those frames are queued when the reply takes over.
+It is paced from the event loop and holds no worker thread while it plays.
+"""
+
+import asyncio
+import random
+import threading
+import time
+
+import numpy as np
+
+from audio_output import PCM_SAMPLE_RATE, PCM_SAMPLE_WIDTH
+from inference_client import percentile
+
+FILLERS = ["Hmm.", "Let me think.", "Well,", "Right, so."]
+
+
+def crossfade(tail, head):
+    """
+    Mixes the tail of the filler, faded out, with the start of the reply, faded
+    in over as many samples.
+
+    :param tail: int16 PCM bytes, the filler not played yet.
+    :param head: int16 PCM bytes, the first chunk of the reply.
+    """
+    fading = np.frombuffer(tail[:len(tail) - len(tail) % PCM_SAMPLE_WIDTH], dtype=np.int16).astype(np.float32)
+    cut = len(head) - len(head) % PCM_SAMPLE_WIDTH  # an odd byte stays for the next chunk
+    rising = np.frombuffer(head[:cut], dtype=np.int16).astype(np.float32)
+    if not fading.size:
+        return head
+    ramp = np.linspace(1.0, 0.0, fading.size, endpoint=False, dtype=np.float32)
+    mixed = np.zeros(max(fading.size, rising.size), dtype=np.float32)
+    mixed[:fading.size] = fading * ramp
+    overlap = min(fading.size, rising.size)
+    mixed[:overlap] += rising[:overlap] * (1.0 - ramp[:overlap])
+    mixed[overlap:rising.size] += rising[overlap:]
+    return np.clip(mixed, -32768, 32767).astype(np.int16).tobytes() + head[cut:]
+
+
+class FillerPlayback:
+    """
+    One filler being played.
+
+    :param audio: The filler, int16 PCM bytes.
+    :param output: The AudioOutput it is played on.
+    :param fade: Seconds of the cross-fade with the reply.
+    :param frame: Seconds of audio written at once.
+    :param lead: Frames written ahead of the playback.
+    """
+
+    def __init__(self, audio, output, fade=0.08, frame=0.02, lead=2):
+        self.audio = audio
+        self.output = output
+        self.fade_bytes = int(fade * PCM_SAMPLE_RATE) * PCM_SAMPLE_WIDTH
+        self.frame_time = frame
+        self.frame_bytes = int(frame * PCM_SAMPLE_RATE) * PCM_SAMPLE_WIDTH
+        self.lead = lead
+        self.lock = threading.Lock()  # the position is shared with the thread playing the reply
+        self.position = 0
+        self.handed_over = False
+        self.stopped = threading.Event()
+        self.started_at = None
+
+    async def play(self):
+        # paced from the event loop, a worker thread held for the whole filler would keep
+        # the synthesis and the playback of the reply waiting in the default executor
+        self.started_at = start = time.perf_counter()
+        self.output.playing.add(self.stopped)  # silenced by AudioOutput.stop() like a reply
+        frames = 0
+        try:
+            while not self.stopped.is_set():
+                with self.lock:
+                    if self.handed_over or self.position >= len(self.audio):
+                        break
+                    chunk = self.audio[self.position:self.position + self.frame_bytes]
+                    self.output.sink.write(chunk)
+                    self.position += len(chunk)
+                frames += 1
+                delay = start + (frames - self.lead) * self.frame_time - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        finally:
+            self.output.playing.discard(self.stopped)
+
+    def take_over(self, chunks):
+        """
+        The reply's PCM chunks, the first one cross-faded with the rest of the
+        filler. The filler is not written anymore once the reply starts.
+        """
+        first = True
+        for chunk in chunks:
+            if first:
+                first = False
+                with self.lock:
+                    self.handed_over = True
+                    tail = self.audio[self.position:self.position + self.fade_bytes]
+                chunk = crossfade(tail, chunk)
+            yield chunk
+
+
+class Fillers:
+    """
+    The fillers of every voice and how often they were played.
+
+    :param phrases: What the agents say while they think.
+    :param threshold: Seconds after the endpoint without a reply before a filler is played.
+    :param fade: Seconds of the cross-fade with the reply.
+    """
+
+    def __init__(self, phrases=FILLERS, threshold=0.5, fade=0.08):
+        self.phrases = list(phrases)
+        self.threshold = threshold
+        self.fade = fade
+        self.audio = {}  # voice -> [PCM bytes of each phrase]
+        self.turns = 0
+        self.fired = 0
+        self.hidden = []  # seconds from the filler to the reply's first audio, heard instead of silence
+
+    async def load(self, synthesize, voices, concurrency=4):
+        """
+        Synthesizes the phrases in every voice, at most concurrency at once.
+
+        :param synthesize: Coroutine function (text, voice) returning PCM chunks, SharedServices.synthesize.
+        """
+        loop = asyncio.get_running_loop()
+        pending = iter([(voice, phrase) for voice in voices for phrase in self.phrases])
+
+        async def worker():
+            for voice, phrase in pending:
+                chunks = await synthesize(phrase, voice)
+                audio = await loop.run_in_executor(None, b"".join, chunks)
+                if audio:
+                    self.audio.setdefault(voice, []).append(audio)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    def pick(self, voice):
+        """
+        :return: The PCM of a filler in the voice, None if none is loaded yet.
+        """
+        audio = self.audio.get(voice)
+        return random.choice(audio) if audio else None
+
+    def playback(self, voice, output):
+        audio = self.pick(voice)
+        if audio is None:
+            return None
+        self.fired += 1
+        return FillerPlayback(audio, output, self.fade)
+
+    def stats(self):
+        return {
+            "voices": len(self.audio),
+            "turns": self.turns,
+            "fired": self.fired,
+            "fire_rate": self.fired / self.turns if self.turns else None,
+            "hidden_p50": percentile(self.hidden, 50),
+            "hidden_p95": percentile(self.hidden, 95),
+            "hidden_total": sum(self.hidden),
+        }
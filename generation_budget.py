@@ -0,0 +1,157 @@
+"""
+Generation parameters sized to a turn latency target.
+
+The requests used to carry no parameters: the reply was as long as the model
+liked, which set the LLM, Polly and playback times, and generated_text echoed
+the prompt, which was then read out loud. GenerationBudget adds to every
+request:
+
+- max_new_tokens: as many tokens as the backend can generate in the time the
+  turn target leaves once the expected speech synthesis latency is taken out.
+  Each backend's fixed overhead and tokens per second are fitted online on its
+  recent requests (latency = overhead + tokens / rate).
+- return_full_text=False, so only the new text comes back.
+- stop sequences: a new line starts another speaker's turn in the prompts.
+
+trim_reply() cleans what comes back for the backends that ignore some of them:
+an echoed prompt, text after a stop sequence, and an unfinished last sentence
+cut by the token limit.
+"""
+
+import collections
+import re
+
+DEFAULT_STOP = ["\n"]
+_SENTENCE_END = re.compile(r"[.!?](?=\s|$)")
+
+
+def trim_reply(prompt, reply, stop=DEFAULT_STOP):
+    if prompt and reply.startswith(prompt):
+        reply = reply[len(prompt):]
+    elif prompt.strip() and reply.lstrip().startswith(prompt.strip()):
+        reply = reply.lstrip()[len(prompt.strip()):]
+    reply = reply.lstrip("\n")
+    for sequence in stop:
+        cut = reply.find(sequence)
+        if cut != -1:
+            reply = reply[:cut]
+    reply = reply.strip()
+    if reply and reply[-1] not in ".!?":
+        # cut by max_new_tokens, the last full sentence is a better place to stop
+        ends = [match.end() for match in _SENTENCE_END.finditer(reply)]
+        if ends:
+            reply = reply[:ends[-1]]
+    return reply
+
+
+class BackendRate:
+    """
+    Least squares fit of latency = overhead + tokens * seconds_per_token over
+    the last requests of a backend.
+    """
+
+    def __init__(self, overhead=0.3, rate=20.0, window=50, min_samples=5):
+        self.default = (overhead, 1.0 / rate)
+        self.samples = collections.deque(maxlen=window)
+        self.min_samples = min_samples
+
+    def observe(self, tokens, seconds):
+        self.samples.append((tokens, seconds))
+
+    def fit(self):
+        """
+        :return: (overhead seconds, seconds per token)
+        """
+        if len(self.samples) < self.min_samples:
+            return self.default
+        n = len(self.samples)
+        mean_tokens = sum(tokens for tokens, _ in self.samples) / n
+        mean_seconds = sum(seconds for _, seconds in self.samples) / n
+        variance = sum((tokens - mean_tokens) ** 2 for tokens, _ in self.samples)
+        if variance == 0:
+            # all replies as long, only the total time per token is known
+            return self.default[0], max(1e-4, (mean_seconds - self.default[0]) / max(mean_tokens, 1))
+        slope = sum((tokens - mean_tokens) * (seconds - mean_seconds) for tokens, seconds in self.samples) / variance
+        slope = max(slope, 1e-4)
+        return max(0.0, mean_seconds - slope * mean_tokens), slope
+
+
+class GenerationBudget:
+    """
+    :param turn_target: Seconds from the end of the user's turn to the agent's
+                        first audio the replies are sized for.
+    :param min_tokens: Never ask for fewer new tokens than this.
+    :param max_tokens: Nor for more than this.
+    :param step: max_new_tokens is rounded down to a multiple of step, so that
+                 concurrent prompts still share a batch.
+    :param stop: Stop sequences.
+    """
+
+    def __init__(self, turn_target=2.0, min_tokens=8, max_tokens=64, step=8, stop=DEFAULT_STOP):
+        self.turn_target = turn_target
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.step = step
+        self.stop = list(stop)
+        self.rates = {}
+        self.tts_latency = 0.3  # expected seconds from the reply to its first audio
+        self.chosen = {}  # model -> the latest max_new_tokens
+
+    def rate(self, model):
+        if model not in self.rates:
+            self.rates[model] = BackendRate()
+        return self.rates[model]
+
+    def observe(self, model, tokens, seconds):
+        self.rate(model).observe(tokens, seconds)
+
+    def observe_tts(self, seconds):
+        self.tts_latency += 0.2 * (seconds - self.tts_latency)
+
+    def max_new_tokens(self, model):
+        overhead, seconds_per_token = self.rate(model).fit()
+        budget = self.turn_target - self.tts_latency - overhead
+        tokens = int(budget / seconds_per_token) // self.step * self.step
+        tokens = min(self.max_tokens, max(self.min_tokens, tokens))
+        self.chosen[model] = tokens
+        return tokens
+
+    def parameters(self, model):
+        return {"max_new_tokens": self.max_new_tokens(model), "return_full_text": False, "stop": list(self.stop)}
+
+    def trim(self, prompt, reply):
+        return trim_reply(prompt, reply, self.stop)
+
+    def stats(self):
+        stats = {"tts_latency": self.tts_latency}
+        for model, rate in self.rates.items():
+            overhead, seconds_per_token = rate.fit()
+            stats[model] = {
+                "overhead": overhead,
+                "tokens_per_s": 1.0 / seconds_per_token,
+                "max_new_tokens": self.chosen.get(model),
+            }
+        return stats
+
+
+async def until_stop(tokens, stop=DEFAULT_STOP):
+    """
+    Passes the streamed text through up to the first stop sequence, for the
+    backends that do not stop there themselves.
+    """
+    text = ""
+    try:
+        async for token in tokens:
+            if not text:
+                token = token.lstrip("\n")  # the reply may start on a line of its own
+            start = len(text)
+            text += token
+            cut = min((text.find(sequence) for sequence in stop if sequence in text), default=-1)
+            if cut != -1:
+                if cut > start:
+                    yield text[start:cut]
+                return
+            if token:
+                yield token
+    finally:
+        await tokens.aclose()
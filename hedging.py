@@ -0,0 +1,117 @@
+"""
+Hedged requests over several text generation backends.
+
+The primary backend is asked first. If it has not answered within hedge_delay
+(or failed, e.g. with a "model is loading" payload) the next backend is asked
+as well, the first valid generated_text wins and the other requests are
+cancelled. Per-backend win rates and latencies are kept so the delay can be
+tuned; with hedge_delay=None it follows the p95 latency of the primary.
+"""
+
+import asyncio
+import collections
+import time
+
+from inference_client import InferenceError, percentile
+
+HEDGE_ERRORS = (InferenceError,)  # transport errors, and error or malformed payloads (InferencePayloadError)
+
+
+class BackendStats:
+    def __init__(self):
+        self.launched = 0
+        self.wins = 0
+        self.failures = 0
+        self.latencies = []  # of the valid answers
+        self.busy = 0.0  # seconds from launch to end of every request, the failed and cancelled ones too
+
+    def as_dict(self):
+        return {
+            "launched": self.launched,
+            "wins": self.wins,
+            "win_rate": self.wins / self.launched if self.launched else None,
+            "failures": self.failures,
+            "latency_p50": percentile(self.latencies, 50),
+            "latency_p95": percentile(self.latencies, 95),
+        }
+
+
+class Hedger:
+    """
+    :param generate: Coroutine function (context, model) returning the reply text.
+    :param backends: Models in order of preference.
+    :param hedge_delay: Seconds before the next backend is fired, 0 fires them
+                        all in parallel, None uses the p95 latency of the primary.
+    :param default_delay: Delay used while there are not enough samples for the p95.
+    """
+
+    def __init__(self, generate, backends, hedge_delay=None, default_delay=1.5, min_samples=20):
+        self.generate = generate
+        self.backends = list(backends)
+        self.hedge_delay = hedge_delay
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        # a model outside the list, e.g. a session's own, gets its stats when first asked
+        self.backend_stats = collections.defaultdict(BackendStats)
+        for backend in self.backends:
+            self.backend_stats[backend] = BackendStats()
+
+    def delay(self, backends):
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        latencies = self.backend_stats[backends[0]].latencies
+        if len(latencies) < self.min_samples:
+            return self.default_delay
+        return percentile(latencies, 95)
+
+    async def _timed(self, context, backend):
+        start = time.perf_counter()
+        try:
+            reply = await self.generate(context, backend)
+        finally:
+            self.backend_stats[backend].busy += time.perf_counter() - start
+        return reply, time.perf_counter() - start
+
+    async def generate_hedged(self, context, backends=None):
+        """
+        Returns the first valid reply. Raises the last error if every backend failed.
+        """
+        backends = list(backends or self.backends)
+        waiting = list(backends)
+        delay = self.delay(backends)
+        running = {}
+        error = None
+
+        def launch():
+            backend = waiting.pop(0)
+            self.backend_stats[backend].launched += 1
+            running[asyncio.ensure_future(self._timed(context, backend))] = backend
+
+        launch()
+        try:
+            while running:
+                done, _ = await asyncio.wait(running, timeout=delay if waiting else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    launch()  # too slow, hedge with the next backend
+                    continue
+                for task in done:
+                    backend = running.pop(task)
+                    try:
+                        reply, latency = task.result()
+                    except HEDGE_ERRORS as failure:
+                        self.backend_stats[backend].failures += 1
+                        error = failure
+                        continue
+                    self.backend_stats[backend].wins += 1
+                    self.backend_stats[backend].latencies.append(latency)
+                    return reply
+                if not running and waiting:
+                    launch()  # failed before the delay, no reason to wait
+        finally:
+            for task in running:
+                task.cancel()
+        raise error
+
+    def stats(self):
+        return {backend: stats.as_dict() for backend, stats in self.backend_stats.items()}
@@ -0,0 +1,235 @@
+"""
+Asynchronous client for the text generation inference API.
+
+A single aiohttp session keeps a pool of keep-alive connections, so the TCP/TLS
+handshake is paid once instead of on every turn, and awaiting a reply never
+blocks the event loop (microphone forwarding and transcription keep running).
+The base url can point to a local stand-in server instead of HuggingFace.
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+
+import aiohttp
+
+from speech_pipeline import aiterate
+
+HF_BASE_URL = "https://api-inference.huggingface.co/models"
+MODEL_PATHS = {"gpt2": "gpt2", "bloom": "bigscience/bloom"}
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class InferenceError(Exception):
+    """
+    Raised when the inference API could not be reached before the deadline.
+    """
+
+
+class InferencePayloadError(InferenceError):
+    """
+    Raised when the model answered with an error payload (e.g. it is still
+    loading) or a body without generated text.
+    """
+
+
+def load_token(path="webis_token.json"):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)["authorization"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def generated_text(body):
+    # gpt2 answers [{...}], bloom [[{...}]], error payloads are {"error": ...}
+    while isinstance(body, list) and body:
+        body = body[0]
+    if isinstance(body, dict) and "error" in body:
+        raise InferencePayloadError(str(body["error"]))
+    if not isinstance(body, dict) or not isinstance(body.get("generated_text"), str):
+        raise InferencePayloadError(f"unexpected answer {str(body)[:80]}")
+    return body["generated_text"]
+
+
+async def _sse_tokens(content):
+    async for line in content:
+        line = line.strip()
+        if not line.startswith(b"data:"):
+            continue
+        data = line[len(b"data:"):].strip()
+        if data == b"[DONE]":
+            break
+        event = json.loads(data)
+        if "error" in event:
+            raise InferencePayloadError(str(event["error"]))
+        token = event.get("token") or {}
+        if token.get("text") and not token.get("special"):
+            yield token["text"]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+class InferenceClient:
+    """
+    Pooled inference client with per-request deadlines and bounded retries.
+
+    :param base_url: Url the model path is appended to. Defaults to the
+                     INFERENCE_BASE_URL environment variable, then HuggingFace.
+    :param token: The api_org token. Defaults to the one in webis_token.json.
+    :param timeout: Deadline in seconds for a request, retries included.
+    :param retries: How many times a failed request is retried.
+    :param backoff: Base delay in seconds between retries, doubled every attempt
+                    and jittered.
+    :param pool_size: Maximum number of open connections.
+    """
+
+    def __init__(self, base_url=None, token=None, timeout=30.0, retries=2, backoff=0.25, pool_size=16):
+        self.base_url = (base_url or os.environ.get("INFERENCE_BASE_URL", HF_BASE_URL)).rstrip("/")
+        self.token = token if token is not None else load_token()
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.session = None
+        self.requests = 0
+        self.retried = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.latencies = []
+        self.first_token_latencies = []
+
+    def url(self, model):
+        return f"{self.base_url}/{MODEL_PATHS.get(model, model)}"
+
+    async def _get_session(self):
+        if self.session is None or self.session.closed:
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self._on_connection_created)
+            trace.on_connection_reuseconn.append(self._on_connection_reused)
+            headers = {"Authorization": f"Bearer api_org_{self.token}"} if self.token else {}
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+                headers=headers,
+                trace_configs=[trace],
+            )
+        return self.session
+
+    async def _on_connection_created(self, session, context, params):
+        self.connections_created += 1
+
+    async def _on_connection_reused(self, session, context, params):
+        self.connections_reused += 1
+
+    async def query(self, model, payload, timeout=None):
+        """
+        Posts the payload to the model and returns the decoded json body. Error
+        payloads (e.g. the model is still loading) are returned as they are once
+        the retries are exhausted, generated_text() raises InferencePayloadError on them.
+        """
+        session = await self._get_session()
+        deadline = time.perf_counter() + (self.timeout if timeout is None else timeout)
+        start = time.perf_counter()
+        self.requests += 1
+        for attempt in range(self.retries + 1):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                async with session.post(self.url(model), json=payload,
+                                        timeout=aiohttp.ClientTimeout(total=remaining)) as response:
+                    body = await response.json(content_type=None)
+                    if response.status not in RETRY_STATUS or attempt == self.retries:
+                        self.latencies.append(time.perf_counter() - start)
+                        return body
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+                if attempt == self.retries:
+                    raise InferenceError(f"{model}: {error!r}") from error
+            self.retried += 1
+            delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            await asyncio.sleep(min(delay, max(0.0, deadline - time.perf_counter())))
+        raise InferenceError(f"{model}: no answer within the deadline")
+
+    async def stream(self, model, payload, timeout=None):
+        """
+        Asks the model to stream its tokens and yields their text as they arrive.
+        Server-sent events in the text-generation-inference format are parsed;
+        a plain json answer (backend without streaming) is yielded in one piece.
+        """
+        session = await self._get_session()
+        start = time.perf_counter()
+        self.requests += 1
+        first = True
+        timeout = aiohttp.ClientTimeout(total=self.timeout if timeout is None else timeout)
+        try:
+            async with session.post(self.url(model), json={**payload, "stream": True},
+                                    timeout=timeout) as response:
+                if response.content_type != "text/event-stream":
+                    body = await response.json(content_type=None)
+                    texts = [generated_text(body)]
+                else:
+                    texts = _sse_tokens(response.content)
+                async for text in aiterate(texts):
+                    if first:
+                        self.first_token_latencies.append(time.perf_counter() - start)
+                        first = False
+                    yield text
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            raise InferenceError(f"{model}: {error!r}") from error
+        except ValueError as error:
+            # not json: an error page of the gateway, or a broken event line
+            raise InferencePayloadError(f"{model}: {error!r}") from error
+        self.latencies.append(time.perf_counter() - start)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "retries": self.retried,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "latency_p50": percentile(self.latencies, 50),
+            "latency_p95": percentile(self.latencies, 95),
+            "first_token_p50": percentile(self.first_token_latencies, 50),
+        }
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+class InferenceRouter:
+    """
+    Sends every model to the client serving it, e.g. the local models to a
+    LocalInference and the others to the inference API, behind the same
+    query() / stream() interface.
+
+    :param default: The client of the models not in clients.
+    :param clients: Model name -> client.
+    """
+
+    def __init__(self, default, clients=None):
+        self.default = default
+        self.clients = dict(clients or {})
+
+    def client(self, model):
+        return self.clients.get(model, self.default)
+
+    async def query(self, model, payload, timeout=None):
+        return await self.client(model).query(model, payload, timeout)
+
+    def stream(self, model, payload, timeout=None):
+        return self.client(model).stream(model, payload, timeout)
+
+    def stats(self):
+        return {"default": self.default.stats(), **{model: client.stats() for model, client in self.clients.items()}}
+
+    async def close(self):
+        for client in {id(client): client for client in [self.default, *self.clients.values()]}.values():
+            await client.close()
@@ -0,0 +1,243 @@
+"""
+In-process text generation on the CPU, for offline operation.
+
+A small causal language model (distilgpt2, gpt2, ...) is loaded once at startup
+with transformers and answers with the same query() / stream() interface and
+reply format as the inference API, so it can stand for a remote model anywhere.
+Models are named "local:<huggingface id>", e.g. MODEL = "local:distilgpt2".
+
+Generation runs in a worker thread of its own, the event loop keeps forwarding
+the microphone meanwhile. Tokens are decoded one at a time with the model's
+key/value cache, and the cache of the previous request is kept: a conversation
+prompt usually starts with the previous prompt and reply, so only the new
+tokens go through the model.
+
+Compare its latency with the inference API:
+
+    python local_inference.py distilgpt2 [--remote gpt2] [--prompts 20]
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+from inference_client import percentile
+
+LOCAL_PREFIX = "local:"
+
+
+def is_local(model):
+    return model.startswith(LOCAL_PREFIX)
+
+
+def _crop(past, length):
+    # the key/value cache of the first length tokens
+    if hasattr(past, "crop"):
+        past.crop(length)
+        return past
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in past)
+
+
+class _Engine:
+    """
+    One loaded model and the cache of the last sequence it went through. Only
+    used from the worker thread.
+    """
+
+    def __init__(self, name, threads):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        torch.set_num_threads(threads)
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(name)
+        self.model = AutoModelForCausalLM.from_pretrained(name)
+        self.model.eval()
+        self.max_positions = getattr(self.model.config, "n_positions", 1024)
+        self.cached_ids = []  # the tokens the cache holds
+        self.past = None
+        self.reused = 0
+        self.fed = 0
+        self.generated = 0
+
+    def _feed(self, ids):
+        # runs the tokens not covered by the cache through the model
+        common = 0
+        for cached, new in zip(self.cached_ids, ids[:-1]):  # the last token is always fed, for its logits
+            if cached != new:
+                break
+            common += 1
+        past = _crop(self.past, common) if common and self.past is not None else None
+        self.reused += common
+        self.fed += len(ids) - common
+        output = self.model(input_ids=self.torch.tensor([ids[common:]]), past_key_values=past, use_cache=True)
+        self.cached_ids = list(ids)
+        self.past = output.past_key_values
+        return output.logits[0, -1]
+
+    def _next(self, logits, parameters):
+        if not parameters.get("do_sample", True):
+            return int(logits.argmax())
+        logits = logits / max(parameters.get("temperature", 1.0), 1e-3)
+        top_k = parameters.get("top_k", 50)
+        values, indices = self.torch.topk(logits, min(top_k, logits.shape[-1]))
+        choice = self.torch.multinomial(self.torch.softmax(values, dim=-1), 1)
+        return int(indices[choice])
+
+    def generate(self, prompt, parameters, on_text=None, cancelled=None):
+        """
+        :param parameters: The inference API parameters: max_new_tokens,
+                           return_full_text, stop, do_sample, temperature, top_k.
+        :param on_text: Called with every new piece of text as it is decoded.
+        :return: The reply body, [{"generated_text": ...}] like gpt2 on the API.
+        """
+        max_new_tokens = parameters.get("max_new_tokens", 40)
+        stops = parameters.get("stop") or []
+        ids = self.tokenizer(prompt).input_ids[-(self.max_positions - max_new_tokens):]
+        with self.torch.no_grad():
+            logits = self._feed(ids)
+            generated, text = [], ""
+            for _ in range(max_new_tokens):
+                if cancelled is not None and cancelled.is_set():
+                    break
+                token = self._next(logits, parameters)
+                if token == self.tokenizer.eos_token_id:
+                    break
+                generated.append(token)
+                decoded = self.tokenizer.decode(generated, skip_special_tokens=True)
+                cut = min((decoded.find(stop) for stop in stops if stop in decoded), default=-1)
+                if cut != -1:
+                    decoded = decoded[:cut]
+                if on_text is not None and len(decoded) > len(text):
+                    on_text(decoded[len(text):])
+                text = decoded
+                if cut != -1:
+                    break
+                logits = self._feed(ids + generated)
+        self.generated += len(generated)
+        full_text = parameters.get("return_full_text", True)
+        return [{"generated_text": prompt + text if full_text else text}]
+
+
+class LocalInference:
+    """
+    In-process backend with the interface of InferenceClient.
+
+    :param models: The "local:<name>" models to load at startup.
+    :param threads: Torch threads per generation.
+    """
+
+    def __init__(self, models, threads=2):
+        self.engines = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="local-llm")
+        for model in models:
+            self.engines[model] = _Engine(model[len(LOCAL_PREFIX):] if is_local(model) else model, threads)
+        self.requests = 0
+        self.latencies = []
+        self.first_token_latencies = []
+
+    async def _run(self, model, prompt, parameters, on_text=None):
+        cancelled = threading.Event()
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.executor, self.engines[model].generate, prompt, parameters,
+                                              on_text, cancelled)
+        except asyncio.CancelledError:
+            cancelled.set()  # e.g. a hedged request that lost, the thread stops at the next token
+            raise
+
+    async def query(self, model, payload, timeout=None):
+        start = time.perf_counter()
+        self.requests += 1
+        parameters = payload.get("parameters", {})
+        inputs = payload["inputs"]
+        if isinstance(inputs, list):
+            body = [await self._run(model, prompt, parameters) for prompt in inputs]
+        else:
+            body = await self._run(model, inputs, parameters)
+        self.latencies.append(time.perf_counter() - start)
+        return body
+
+    async def stream(self, model, payload, timeout=None):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        start = time.perf_counter()
+        self.requests += 1
+
+        def on_text(text):
+            loop.call_soon_threadsafe(queue.put_nowait, text)
+
+        generation = asyncio.ensure_future(self._run(model, payload["inputs"], payload.get("parameters", {}),
+                                                     on_text))
+        generation.add_done_callback(lambda _: queue.put_nowait(None))
+        first = True
+        try:
+            while True:
+                text = await queue.get()
+                if text is None:
+                    break
+                if first:
+                    self.first_token_latencies.append(time.perf_counter() - start)
+                    first = False
+                yield text
+            generation.result()  # raises what went wrong in the thread
+        finally:
+            generation.cancel()
+        self.latencies.append(time.perf_counter() - start)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "latency_p50": percentile(self.latencies, 50),
+            "latency_p95": percentile(self.latencies, 95),
+            "first_token_p50": percentile(self.first_token_latencies, 50),
+            "engines": {
+                model: {"tokens_fed": engine.fed, "tokens_reused": engine.reused, "tokens_generated": engine.generated}
+                for model, engine in self.engines.items()
+            },
+        }
+
+    async def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def compare(local_model, remote_model, prompts):
+    from inference_client import InferenceClient
+
+    backends = {local_model: LocalInference([local_model])}
+    if remote_model:
+        backends[remote_model] = InferenceClient()
+    results = {}
+    for model, client in backends.items():
+        context, latencies = "Hello, how are you today?", []
+        for _ in range(prompts):
+            start = time.perf_counter()
+            try:
+                body = await client.query(model, {"inputs": context, "parameters": {"max_new_tokens": 30}})
+            except Exception as error:  # the remote path may be offline, that is the point
+                print(f"{model}: {error!r}")
+                break
+            latencies.append(time.perf_counter() - start)
+            context = str(body[0].get("generated_text", context)) if isinstance(body, list) else context
+        results[model] = latencies
+        print(f"{model:>24}: p50 {(percentile(latencies, 50) or 0) * 1000:7.0f} ms  "
+              f"p95 {(percentile(latencies, 95) or 0) * 1000:7.0f} ms  ({len(latencies)} prompts)")
+        if hasattr(client, "engines"):
+            print(f"{'':>24}  {client.stats()['engines'][model]}")
+        await client.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency of the local model against the inference API")
+    parser.add_argument("model", help="huggingface id of the local model, e.g. distilgpt2")
+    parser.add_argument("--remote", help="model to time on the inference API, e.g. gpt2")
+    parser.add_argument("--prompts", type=int, default=20, help="turns of a growing conversation")
+    args = parser.parse_args()
+    asyncio.run(compare(LOCAL_PREFIX + args.model, args.remote, args.prompts))
+
+
+if __name__ == "__main__":
+    main()
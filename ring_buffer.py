@@ -0,0 +1,155 @@
+"""
+Preallocated ring of audio blocks between the sound card thread and the event loop.
+
+The capture callback copies each block into a slot allocated once at start,
+instead of making a new bytes object per block and queueing it on an unbounded
+asyncio.Queue. The ring holds a fixed number of blocks, so a stalled consumer
+(e.g. the Transcribe send) cannot grow memory; what happens when it is full is
+the policy:
+
+- "drop_oldest": the oldest unread block is overwritten, the capture thread
+  never waits. This is what the microphone needs, PortAudio must not be blocked.
+- "block": the writer waits up to block_timeout for room, then drops the new
+  block. For producers that can afford to wait, e.g. a file or socket reader.
+
+Readers get a memoryview of a slot, valid until their next read(). The event
+loop is woken once per batch of blocks written while it was busy, not once
+per block. Overruns, dropped blocks and the queue depth are counted.
+"""
+
+import asyncio
+import threading
+
+POLICIES = ("drop_oldest", "block")
+
+
+class RingBuffer:
+    """
+    :param block_bytes: Size of a slot, the largest block written at once.
+    :param blocks: Number of slots.
+    :param policy: "drop_oldest" or "block", see the module docstring.
+    :param block_timeout: Seconds the "block" policy waits for room.
+    """
+
+    def __init__(self, block_bytes, blocks=64, policy="drop_oldest", block_timeout=0.5):
+        if policy not in POLICIES:
+            raise ValueError(f"policy must be one of {POLICIES}, not {policy!r}")
+        self.block_bytes = block_bytes
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.slots = [bytearray(block_bytes) for _ in range(blocks)]
+        self.lengths = [0] * blocks
+        self.statuses = [None] * blocks
+        # the slot handed to the reader is swapped out of the ring so the writer never touches it
+        self.spare = bytearray(block_bytes)
+        self.head = 0  # next slot written
+        self.tail = 0  # next slot read
+        self.depth = 0  # unread blocks
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+        self.loop = None
+        self.readable = None
+        self.wake_pending = False
+        self.closed = False
+
+        self.writes = 0
+        self.overruns = 0  # writes that found the ring full
+        self.dropped = 0  # blocks lost to overruns
+        self.max_depth = 0
+        self.wakeups = 0
+
+    def attach(self, loop):
+        # the event loop the reader runs on, called before the writer starts
+        self.loop = loop
+        self.readable = asyncio.Event()
+
+    def write(self, data, status=None):
+        """
+        Copies data into the ring, from any thread. Returns False if it was dropped.
+        """
+        size = len(data)
+        if size > self.block_bytes:
+            raise ValueError(f"block of {size} bytes does not fit in slots of {self.block_bytes}")
+        with self.lock:
+            if self.closed:
+                return False
+            self.writes += 1
+            if self.depth == len(self.slots):
+                self.overruns += 1
+                if self.policy == "block":
+                    self.not_full.wait_for(lambda: self.depth < len(self.slots) or self.closed, self.block_timeout)
+                if self.depth == len(self.slots) or self.closed:
+                    if self.policy == "block":
+                        # timed out, the new block is the one lost
+                        self.dropped += 1
+                        return False
+                    # drop_oldest: the oldest unread slot is reused for the new block
+                    self.tail = (self.tail + 1) % len(self.slots)
+                    self.depth -= 1
+                    self.dropped += 1
+            slot = self.head
+            self.slots[slot][:size] = data
+            self.lengths[slot] = size
+            self.statuses[slot] = status
+            self.head = (slot + 1) % len(self.slots)
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            wake = not self.wake_pending and self.loop is not None
+            self.wake_pending = True
+        if wake:
+            # one callback for all the blocks written until the loop gets to it
+            self.wakeups += 1
+            self.loop.call_soon_threadsafe(self._wake)
+        return True
+
+    def _wake(self):
+        with self.lock:
+            self.wake_pending = False
+        self.readable.set()
+
+    def read_nowait(self):
+        """
+        The oldest unread (memoryview, status), or None if the ring is empty.
+        """
+        with self.lock:
+            if not self.depth:
+                return None
+            slot = self.tail
+            self.spare, self.slots[slot] = self.slots[slot], self.spare
+            size, status = self.lengths[slot], self.statuses[slot]
+            self.tail = (slot + 1) % len(self.slots)
+            self.depth -= 1
+            self.not_full.notify()
+            return memoryview(self.spare)[:size], status
+
+    async def read(self):
+        """
+        Waits for the next (memoryview, status). The view is reused by the next read.
+        """
+        while True:
+            item = self.read_nowait()
+            if item is not None or self.closed:
+                return item
+            self.readable.clear()
+            # a block may have landed between read_nowait() and clear()
+            if self.depth:
+                continue
+            await self.readable.wait()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.not_full.notify_all()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.readable.set)
+
+    def stats(self):
+        return {
+            "capacity": len(self.slots),
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "writes": self.writes,
+            "overruns": self.overruns,
+            "dropped": self.dropped,
+            "wakeups": self.wakeups,
+        }
@@ -0,0 +1,108 @@
+"""
+Speculative generation from partial transcripts.
+
+Transcribe keeps sending partial results while the user talks. Once the partial
+transcript has not changed for stable_time the LLM request is started, so by
+the time the turn ends the reply is often already there. If the final text is
+different the speculative request is cancelled and a new one is made.
+"""
+
+import asyncio
+import re
+import time
+
+_PUNCTUATION = re.compile(r"[^\w\s']")
+
+
+def normalize(text):
+    # final results add punctuation and casing that partial results lack
+    return " ".join(_PUNCTUATION.sub(" ", text.lower()).split())
+
+
+class Speculator:
+    """
+    :param generate: Coroutine function taking the context and returning the reply.
+    :param stable_time: Seconds a partial transcript must stay the same before
+                        a request is started for it.
+    """
+
+    def __init__(self, generate, stable_time=0.4):
+        self.generate = generate
+        self.stable_time = stable_time
+        self.timer = None
+        self.pending = None  # normalized text the timer was set for
+        self.text = None  # normalized text of the in-flight speculation
+        self.task = None
+        self.started = None
+        self.hits = 0
+        self.misses = 0
+        self.saved = []  # seconds of inference already done when a hit was claimed
+
+    def on_transcript(self, text):
+        key = normalize(text)
+        if not key or key == self.text or key == self.pending:
+            # Transcribe repeats the same partial while the user talks, the words are still stable
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.pending = key
+        self.timer = asyncio.get_running_loop().call_later(self.stable_time, self._speculate, text)
+
+    def _speculate(self, text):
+        self.timer = None
+        self.pending = None
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.text = normalize(text)
+        self.started = time.perf_counter()
+        self.task = asyncio.ensure_future(self._timed(text))
+
+    async def _timed(self, text):
+        reply = await self.generate(text)
+        return reply, time.perf_counter()
+
+    def matches(self, text):
+        # a speculative request is in flight for these words
+        return self.task is not None and self.text == normalize(text)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.pending = None
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.task = None
+        self.text = None
+
+    async def result(self, text):
+        """
+        Returns the reply for the final transcript, reusing the speculative
+        request when it was made for the same words.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.pending = None
+        task, key = self.task, self.text
+        self.task, self.text = None, None
+        if task is not None and key == normalize(text):
+            self.hits += 1
+            claimed = time.perf_counter()
+            reply, finished = await task
+            # the inference time that overlapped with the user still talking
+            self.saved.append(min(claimed, finished) - self.started)
+            return reply
+        if task is not None:
+            task.cancel()
+        self.misses += 1
+        return await self.generate(text)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else None,
+            "saved_avg": sum(self.saved) / len(self.saved) if self.saved else None,
+        }
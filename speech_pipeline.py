@@ -0,0 +1,107 @@
+"""
+Sentence pipelined speech.
+
+The reply is split in sentences and sentence N+1 is synthesized while sentence
+N is playing, so the user hears the agent after the synthesis of the first
+sentence instead of the whole paragraph. The first sentence is played while it
+downloads; the following ones are fetched into a bounded queue, which keeps
+memory flat however long the reply is.
+"""
+
+import asyncio
+import re
+import time
+
+_SENTENCE_END = re.compile(r"(?<=[.!?;])\s+")
+_CLAUSE_END = re.compile(r"(?<=[,:])\s+")
+
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in _SENTENCE_END.split(text) if sentence.strip()]
+
+
+async def aiterate(items):
+    # an iterable or async iterable, iterated asynchronously
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def sentence_stream(tokens, min_clause=40):
+    """
+    Groups streamed tokens into sentences, yielding each one as soon as its
+    boundary arrives. A long enough clause is let through at a comma so the
+    first audio of a long sentence does not wait for its full stop.
+    """
+    buffer = ""
+    first = True
+    async for token in aiterate(tokens):
+        buffer += token
+        while True:
+            match = _SENTENCE_END.search(buffer)
+            if match is None and first and len(buffer) >= min_clause:
+                match = _CLAUSE_END.search(buffer, min_clause // 2)
+            if match is None:
+                break
+            sentence, buffer = buffer[:match.start()].strip(), buffer[match.end():]
+            if sentence:
+                first = False
+                yield sentence
+    if buffer.strip():
+        yield buffer.strip()
+
+
+async def speak(sentences, synthesize, output, prefetch=2, start=None):
+    """
+    Plays the sentences one after the other, synthesizing ahead of playback.
+
+    :param sentences: An iterable or async iterable of sentences.
+    :param synthesize: Coroutine function returning an iterable of PCM chunks for
+                       a sentence.
+    :param output: The AudioOutput to play on.
+    :param prefetch: How many synthesized sentences may wait for playback.
+    :param start: perf_counter() time the first audio is measured from.
+    :return: The time to first audio in seconds, or None if nothing was played.
+    """
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter() if start is None else start
+    queue = asyncio.Queue(maxsize=prefetch)
+    failure = None
+
+    async def produce():
+        nonlocal failure
+        try:
+            first = True
+            async for sentence in aiterate(sentences):
+                chunks = await synthesize(sentence)
+                if not first:
+                    # downloaded now, while the previous sentence is playing
+                    chunks = [await loop.run_in_executor(None, b"".join, chunks)]
+                first = False
+                await queue.put(chunks)
+        except Exception as error:
+            failure = error
+        finally:
+            if hasattr(sentences, "aclose"):
+                # when cancelled too, a streamed reply releases its connection right away
+                await sentences.aclose()
+        await queue.put(None)
+
+    producer = asyncio.create_task(produce())
+    first_audio = None
+    try:
+        while True:
+            chunks = await queue.get()
+            if chunks is None:
+                break
+            played = await output.play(chunks, start)
+            if first_audio is None:
+                first_audio = played
+    finally:
+        producer.cancel()
+    if failure is not None:
+        raise failure
+    return first_audio
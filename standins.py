@@ -0,0 +1,318 @@
+"""
+Local stand-ins for Amazon Transcribe, Amazon Polly and the inference API.
+
+They let the conversation loop run without a microphone, AWS or HuggingFace,
+each with a configurable latency distribution (see benchmark.py).
+Running this file starts many ConversationSessions on one event loop, each one
+talking to its own stand-in transcription, and checks that no session hears or
+says anything of another one:
+
+    python standins.py [sessions] [turns]
+
+test_sessions.py runs the same check under pytest.
+"""
+
+import asyncio
+import io
+import json
+import re
+import sys
+import time
+
+import numpy as np
+from amazon_transcribe.model import Alternative, Result, Transcript, TranscriptEvent
+
+from audio_output import PCM_SAMPLE_RATE, AudioOutput, NullSink
+from audio_sources import BLOCK_SIZE, AudioSource
+from conversation import ConversationSession, SharedServices, run_sessions
+from tts_cache import TTSCache
+
+
+class Latency:
+    """
+    Log-normal latency distribution given by its median and p95, in seconds.
+    A plain number is a constant latency.
+    """
+
+    def __init__(self, median=0.0, p95=None, seed=None):
+        self.median = median
+        self.sigma = np.log(p95 / median) / 1.645 if p95 and median else 0.0
+        self.rng = np.random.default_rng(seed)
+
+    def sample(self):
+        if not self.median:
+            return 0.0
+        return float(self.median * np.exp(self.sigma * self.rng.standard_normal()))
+
+
+def as_latency(latency):
+    return latency if isinstance(latency, Latency) else Latency(latency)
+
+
+class FakeAudioStream:
+    # The parts of botocore's StreamingBody used by pcm_chunks.
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def iter_chunks(self, chunk_size):
+        while True:
+            chunk = self.data.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        self.data.close()
+
+
+class FakePolly:
+    """
+    synthesize_speech answering silence as long as the text would take to say.
+    """
+
+    def __init__(self, latency=0.0, seconds_per_char=0.06):
+        self.latency = as_latency(latency)
+        self.seconds_per_char = seconds_per_char
+        self.requests = 0
+
+    def synthesize_speech(self, Text, VoiceId, SampleRate=str(PCM_SAMPLE_RATE), **kwargs):
+        self.requests += 1
+        time.sleep(self.latency.sample())  # called from the executor like the real client
+        samples = int(len(Text) * self.seconds_per_char * int(SampleRate))
+        return {"AudioStream": FakeAudioStream(b"\x00\x00" * samples)}
+
+
+class FakeInference:
+    """
+    Stand-in for InferenceClient, the reply repeats the last line of the prompt
+    and numbers itself, so that consecutive replies differ. The generation
+    parameters max_new_tokens (in words), return_full_text and stop are honoured.
+
+    :param capacity: Requests the backend works on at once, the others wait
+                     like on a server with a few workers. None for no limit.
+    :param token_time: Seconds per generated word, on top of the latency.
+    """
+
+    def __init__(self, latency=0.0, capacity=None, token_time=0.0):
+        self.latency = as_latency(latency)
+        self.token_time = token_time
+        self.requests = 0
+        self.replies = 0
+        self.workers = asyncio.Semaphore(capacity) if capacity else None
+
+    def continuation(self, context, parameters):
+        self.replies += 1
+        line = context.splitlines()[-1] if context.strip() else context
+        words = f" Reply {self.replies}: {line} is what you said.".split(" ")
+        text = " ".join(words[:parameters.get("max_new_tokens", len(words)) + 1])
+        for stop in parameters.get("stop") or []:
+            if stop in text:
+                text = text[:text.index(stop)]
+        return text
+
+    def generated_text(self, context, text, parameters):
+        return context + text if parameters.get("return_full_text", True) else text
+
+    async def _work(self, tokens=0):
+        delay = self.latency.sample() + tokens * self.token_time
+        if self.workers is None:
+            await asyncio.sleep(delay)
+            return
+        async with self.workers:
+            await asyncio.sleep(delay)
+
+    async def query(self, model, payload, timeout=None):
+        self.requests += 1
+        parameters = payload.get("parameters", {})
+        inputs = payload["inputs"] if isinstance(payload["inputs"], list) else [payload["inputs"]]
+        texts = [self.continuation(prompt, parameters) for prompt in inputs]
+        # a batch takes as long as its longest reply
+        await self._work(max(len(text.split()) for text in texts))
+        if isinstance(payload["inputs"], list):
+            return [[{"generated_text": self.generated_text(prompt, text, parameters)}]
+                    for prompt, text in zip(inputs, texts)]
+        reply = [{"generated_text": self.generated_text(inputs[0], texts[0], parameters)}]
+        return [reply] if model == "bloom" else reply
+
+    async def stream(self, model, payload, timeout=None):
+        # like text-generation-inference, only the new tokens are streamed
+        self.requests += 1
+        await self._work()
+        for word in self.continuation(payload["inputs"], payload.get("parameters", {})).split(" "):
+            if word:
+                await asyncio.sleep(self.token_time)
+                yield " " + word
+
+    def stats(self):
+        return {"requests": self.requests}
+
+    async def close(self):
+        pass
+
+
+def inference_app(latency=0.0, token_time=0.02):
+    """
+    aiohttp application answering like the HuggingFace inference API, to run
+    the real InferenceClient against. Streams server-sent events when asked to.
+    """
+    from aiohttp import web
+
+    fake = FakeInference(latency)
+
+    async def generate(request):
+        model = request.match_info["model"]
+        payload = await request.json()
+        if not payload.get("stream"):
+            return web.json_response(await fake.query(model, payload))
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        async for token in fake.stream(model, payload):
+            await response.write(f"data:{json.dumps({'token': {'text': token, 'special': False}})}\n\n".encode())
+            await asyncio.sleep(token_time)
+        return response
+
+    app = web.Application()
+    app.router.add_post("/{model:.*}", generate)
+    return app
+
+
+class _FakeInputStream:
+    def __init__(self, client):
+        self.client = client
+
+    async def send_audio_event(self, audio_chunk):
+        self.client.receive(audio_chunk)
+
+    async def end_stream(self):
+        self.client.results.put_nowait(None)
+
+
+class _FakeOutputStream:
+    def __init__(self, results):
+        self.results = results
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.results.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+
+class _FakeStream:
+    def __init__(self, client):
+        self.input_stream = _FakeInputStream(client)
+        self.output_stream = _FakeOutputStream(client.results)
+
+
+class FakeTranscribeClient:
+    """
+    Stand-in for TranscribeStreamingClient. While loud audio comes in it sends
+    partial results revealing the words of text one by one, and a final result
+    once the audio is quiet again.
+    """
+
+    def __init__(self, text, latency=0.0, result_latency=0.0, threshold_db=-40.0, words_per_second=6.0):
+        self.words = text.split()
+        self.latency = as_latency(latency)
+        self.result_latency = as_latency(result_latency)
+        self.next_result = 0.0
+        self.threshold_db = threshold_db
+        self.words_per_second = words_per_second
+        self.results = None
+        self.voiced = 0.0
+
+    async def start_stream_transcription(self, **kwargs):
+        await asyncio.sleep(self.latency.sample())
+        self.results = asyncio.Queue()
+        return _FakeStream(self)
+
+    def _event(self, is_partial):
+        count = max(1, min(len(self.words), int(self.voiced * self.words_per_second)))
+        text = " ".join(self.words if not is_partial else self.words[:count])
+        if not is_partial:
+            text += "."
+        result = Result(is_partial=is_partial, alternatives=[Alternative(text, [], [])])
+        return TranscriptEvent(Transcript([result]))
+
+    def send(self, event):
+        # every result comes result_latency after its audio, never before the previous one
+        loop = asyncio.get_running_loop()
+        self.next_result = max(self.next_result, loop.time() + self.result_latency.sample())
+        loop.call_at(self.next_result, self.results.put_nowait, event)
+
+    def receive(self, chunk):
+        samples = np.frombuffer(chunk, dtype=np.int16).astype(np.float32)
+        if not samples.size:
+            return
+        level = 10 * np.log10(np.mean(samples * samples) + 1e-9) - 20 * np.log10(32768)
+        if level > self.threshold_db:
+            self.voiced += samples.size / PCM_SAMPLE_RATE
+            self.send(self._event(is_partial=True))
+        elif self.voiced:
+            self.send(self._event(is_partial=False))
+            self.voiced = 0.0
+
+
+def utterance_blocks(speech=1.0, pause=2.0, sample_rate=PCM_SAMPLE_RATE, block_size=BLOCK_SIZE):
+    """
+    One utterance: a voiced tone for speech seconds then pause seconds of quiet,
+    as int16 blocks.
+    """
+    t = np.arange(int((speech + pause) * sample_rate)) / sample_rate
+    signal = np.where(t < speech, 8000 * np.sin(2 * np.pi * 180 * t), 0).astype(np.int16)
+    data = signal.tobytes()
+    step = block_size * 2
+    return [data[ix:ix + step] for ix in range(0, len(data), step)]
+
+
+class SyntheticSource(AudioSource):
+    """
+    Repeats an utterance forever at speed times real time.
+    """
+
+    def __init__(self, speed=1.0, gate="pass", **kwargs):
+        super().__init__(gate)
+        self.speed = speed
+        self.utterance = utterance_blocks(**kwargs)
+
+    async def blocks(self):
+        block_time = BLOCK_SIZE / PCM_SAMPLE_RATE / self.speed
+        while True:
+            for block in self.utterance:
+                await asyncio.sleep(block_time)
+                yield block, None
+
+
+async def run_demo(sessions=20, turns=3, speed=2.0):
+    services = SharedServices(FakePolly(), FakeInference(), TTSCache())
+    conversations = []
+    for ix in range(sessions):
+        words = f"hello from session {ix}"
+        conversations.append(ConversationSession(
+            services, AudioOutput(NullSink()), source=SyntheticSource(speed=speed, speech=2.0),
+            transcribe_client_factory=lambda words=words: FakeTranscribeClient(words),
+            mode=1, chunk_time_size=3, quiet=True))
+    start = time.perf_counter()
+    await run_sessions(services, conversations, turns=turns)
+    elapsed = time.perf_counter() - start
+
+    failures = 0
+    for ix, conversation in enumerate(conversations):
+        own = f"hello from session {ix}"
+        # a speculated reply answers the partial transcript, which has no full stop
+        if conversation.last_heard != own + "." or not re.search(rf"\b{own}\b", conversation.last_said):
+            failures += 1
+            print(f"session {ix} mixed up: heard {conversation.last_heard!r}, said {conversation.last_said!r}")
+    print(f"{sessions} sessions x {turns} turns in {elapsed:.1f} s, {failures} not isolated")
+    print(f"speculation hits: {sum(c.speculator.hits for c in conversations)}, "
+          f"misses: {sum(c.speculator.misses for c in conversations)}")
+    await services.close()
+    return failures
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    sys.exit(1 if asyncio.run(run_demo(*args)) else 0)
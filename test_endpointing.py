@@ -0,0 +1,29 @@
+import wave
+
+import numpy as np
+
+from endpointing import replay, timing_errors
+
+SAMPLE_RATE = 16000
+
+
+def utterance(seconds):
+    # a voiced tone rising and falling with the syllables, four a second
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    return 8000 * np.sin(2 * np.pi * 180 * t) * (0.6 + 0.4 * np.sin(2 * np.pi * 4 * t))
+
+
+def silence(seconds):
+    return np.random.default_rng(0).normal(0, 20, int(seconds * SAMPLE_RATE))
+
+
+def test_endpoints_one_hangover_after_the_speech(tmp_path):
+    path = str(tmp_path / "turns.wav")
+    audio = np.concatenate([silence(0.5), utterance(1.5), silence(2.0), utterance(1.0), silence(2.0)])
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(audio.astype(np.int16).tobytes())
+    # the speech ends at 2.0 s and 5.0 s, the default hangover is 0.7 s
+    assert timing_errors(replay(path), [2.7, 5.7], tolerance=0.1) == []
@@ -0,0 +1,8 @@
+import asyncio
+
+from standins import run_demo
+
+
+def test_sessions_are_isolated():
+    # every session hears only its own words and answers only them
+    assert asyncio.run(run_demo(sessions=10, turns=2)) == 0
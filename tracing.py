@@ -0,0 +1,178 @@
+"""
+Per-turn tracing and metrics.
+
+Every turn of a conversation gets a trace id and each stage of it (capture,
+endpoint, LLM request, TTS request, first audio, playback) is recorded as a
+span. Spans are appended to a JSONL file and feed Prometheus style counters
+and histograms, served as text on /metrics.
+
+When tracing is disabled start_turn() returns a shared no-op turn, so the
+instrumented code pays one attribute lookup and call per span and nothing else.
+"""
+
+import asyncio
+import json
+import time
+import uuid
+
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for ix, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[ix] += 1
+
+
+class Metrics:
+    """
+    Counters and histograms identified by name and labels, rendered in the
+    Prometheus text exposition format.
+    """
+
+    def __init__(self, prefix="voice_assistant"):
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+    def render(self):
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{self.prefix}_{name}_total{self._labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            metric = f"{self.prefix}_{name}_seconds"
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(f"{metric}_bucket{self._labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{metric}_bucket{self._labels(labels, [('le', '+Inf')])} {histogram.count}")
+            lines.append(f"{metric}_sum{self._labels(labels)} {histogram.sum}")
+            lines.append(f"{metric}_count{self._labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+class Turn:
+    """
+    The spans of one turn. Times are perf_counter() values.
+    """
+
+    def __init__(self, tracer, session):
+        self.tracer = tracer
+        self.session = session
+        self.trace_id = uuid.uuid4().hex[:16]
+
+    def span(self, name, start, end=None, **attributes):
+        if start is None:
+            return
+        end = start if end is None else end
+        self.tracer.record(self, name, start, end, attributes)
+
+
+class _NullTurn:
+    trace_id = None
+
+    def span(self, name, start, end=None, **attributes):
+        pass
+
+
+NULL_TURN = _NullTurn()
+
+
+class Tracer:
+    """
+    :param path: JSONL file the spans are appended to, None to keep only the metrics.
+    :param enabled: When False nothing is recorded.
+    """
+
+    def __init__(self, path=None, enabled=True):
+        self.enabled = enabled
+        self.metrics = Metrics()
+        self.file = open(path, "a") if path and enabled else None
+        # perf_counter() values are converted to epoch seconds in the trace file
+        self.epoch_offset = time.time() - time.perf_counter()
+
+    def start_turn(self, session=""):
+        if not self.enabled:
+            return NULL_TURN
+        self.metrics.inc("turns", session=session)
+        return Turn(self, session)
+
+    def record(self, turn, name, start, end, attributes):
+        self.metrics.observe("stage", end - start, stage=name)
+        if self.file is not None:
+            self.file.write(json.dumps({
+                "trace_id": turn.trace_id,
+                "session": turn.session,
+                "span": name,
+                "start": start + self.epoch_offset,
+                "end": end + self.epoch_offset,
+                "duration": end - start,
+                **attributes,
+            }) + "\n")
+
+    def count(self, name, value=1, **labels):
+        if self.enabled:
+            self.metrics.inc(name, value, **labels)
+
+    def observe(self, name, value, **labels):
+        if self.enabled:
+            self.metrics.observe(name, value, **labels)
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    async def serve_metrics(self, host="127.0.0.1", port=9100):
+        """
+        Serves the metrics as text/plain on any path until cancelled. Only on
+        the local interface by default, host="0.0.0.0" exposes them to the network.
+        """
+
+        async def handle(reader, writer):
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                writer.close()
+                return
+            body = self.metrics.render().encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+            await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+NULL_TRACER = Tracer(enabled=False)
@@ -0,0 +1,136 @@
+"""
+One long-lived Amazon Transcribe streaming session per conversation.
+
+The microphone keeps feeding the same transcription stream across turns, so the
+handshake and the model warm-up on the service side are paid once. When the
+service drops the stream (bad request, 15 s without audio, 4 h limit) it is
+reopened with exponential backoff and the reconnection is counted. Unexpected
+errors are printed and reconnected the same way; if the audio forwarding fails
+there is nothing left to transcribe and run() raises its error.
+"""
+
+import asyncio
+import random
+import time
+
+from amazon_transcribe.client import TranscribeStreamingClient
+from amazon_transcribe.exceptions import SDKError
+from awscrt.exceptions import AwsCrtError
+
+
+class TranscriptionSession:
+    """
+    :param handler_class: A TranscriptResultStreamHandler subclass, instantiated
+                          with the output stream of every connection.
+    :param chunks: Async iterator of (audio_chunk, status) tuples, e.g. mic_stream().
+                   It is consumed once for the whole session.
+    :param client_factory: Callable returning a TranscribeStreamingClient.
+    :param upstream: An UpstreamAudio encoding and thinning out the chunks, raw
+                     PCM is sent as it comes if None.
+    """
+
+    def __init__(self, handler_class, chunks, region="us-west-2", language_code="en-US",
+                 sample_rate=16000, media_encoding="pcm", client_factory=None,
+                 min_backoff=0.1, max_backoff=8.0, upstream=None):
+        self.handler_class = handler_class
+        self.chunks = chunks
+        self.client_factory = client_factory or (lambda: TranscribeStreamingClient(region=region))
+        self.language_code = language_code
+        self.sample_rate = sample_rate
+        self.upstream = upstream
+        self.media_encoding = media_encoding if upstream is None else upstream.encoding
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stream = None
+        self.connected = asyncio.Event()
+        self.closed = False
+        self.forwarder = None
+        self.reconnects = 0
+        self.reconnect_latencies = []
+        self.last_error = None
+        self.failure = None  # what stopped the audio forwarding
+
+    async def connect(self):
+        start = time.perf_counter()
+        client = self.client_factory()
+        self.stream = await client.start_stream_transcription(
+            language_code=self.language_code,
+            media_sample_rate_hz=self.sample_rate,
+            media_encoding=self.media_encoding,
+        )
+        if self.upstream is not None:
+            self.upstream.start()  # a new stream starts with a new header
+        self.connected.set()
+        return time.perf_counter() - start
+
+    async def forward_chunks(self):
+        # Single reader of the audio source, it outlives the reconnections so
+        # the microphone generator is never closed in between.
+        async for chunk, status in self.chunks:
+            await self.connected.wait()
+            if self.upstream is not None:
+                chunk = self.upstream.encode(chunk)
+                if not chunk:  # left out, or still in the encoder
+                    continue
+            try:
+                await self.stream.input_stream.send_audio_event(audio_chunk=chunk)
+            except Exception:  # the stream is being replaced, the chunk is dropped
+                self.connected.clear()
+
+    def _forwarded(self, forwarder):
+        if not forwarder.cancelled() and forwarder.exception() is not None:
+            self.failure = forwarder.exception()
+            print(f"[transcription]... audio forwarding failed: {self.failure!r}")
+
+    async def run(self):
+        self.forwarder = asyncio.create_task(self.forward_chunks())
+        self.forwarder.add_done_callback(self._forwarded)
+        backoff = self.min_backoff
+        first = True
+        while not self.closed:
+            if self.failure is not None:
+                raise self.failure
+            try:
+                latency = await self.connect()
+                if not first:
+                    self.reconnects += 1
+                    self.reconnect_latencies.append(latency)
+                first = False
+                backoff = self.min_backoff
+                handler = self.handler_class(self.stream.output_stream)
+                # returns when the service closes the stream, e.g. after it expired
+                await handler.handle_events()
+            except (SDKError, AwsCrtError) as error:
+                self.last_error = error
+            except Exception as error:
+                # not a dropped stream, shown but reconnected all the same
+                self.last_error = error
+                print(f"[transcription]... {error!r}")
+            finally:
+                self.connected.clear()
+            if self.closed:
+                break
+            await asyncio.sleep(backoff * random.uniform(0.5, 1.0))
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def close(self):
+        self.closed = True
+        if self.forwarder is not None:
+            self.forwarder.cancel()
+        if self.stream is not None and self.connected.is_set():
+            try:
+                if self.upstream is not None:
+                    tail = self.upstream.flush()
+                    if tail:
+                        await self.stream.input_stream.send_audio_event(audio_chunk=tail)
+                await self.stream.input_stream.end_stream()
+            except Exception:
+                pass
+
+    def stats(self):
+        latencies = self.reconnect_latencies
+        return {
+            "reconnects": self.reconnects,
+            "reconnect_latency_avg": sum(latencies) / len(latencies) if latencies else None,
+            "upstream": self.upstream.stats() if self.upstream is not None else None,
+        }
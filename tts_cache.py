@@ -0,0 +1,163 @@
+"""
+Content addressed cache for the audio synthesized by Amazon Polly.
+
+Greetings, fallbacks and the short MODE 2 continuations come back again and
+again, so the audio is kept in an in-memory LRU and in a directory on disk
+shared by every session on the machine. Entries are keyed by everything that
+changes the audio (voice, engine, format, sample rate and the normalized text).
+Files are written atomically with a rename, so concurrent sessions never see a
+partial file, and both tiers are evicted by size, least recently used first.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+
+class TTSCache:
+    """
+    :param directory: Where the audio files are kept, None for memory only.
+    :param memory_bytes: Size limit of the in-memory tier.
+    :param disk_bytes: Size limit of the directory.
+    """
+
+    def __init__(self, directory=None, memory_bytes=32 * 2 ** 20, disk_bytes=512 * 2 ** 20):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.lock = threading.Lock()  # filled from the playback worker threads
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self.bytes_stored = 0
+        self.disk_size = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.disk_size = sum(size for _, size, _ in self._disk_entries())
+
+    @staticmethod
+    def key(voice, engine, output_format, sample_rate, text):
+        parts = [voice, engine, output_format, str(sample_rate), normalize_text(text)]
+        return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pcm")
+
+    def get(self, key):
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                self.bytes_served += len(data)
+                return data
+        if self.directory is not None:
+            path = self._path(key)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                os.utime(path)  # recently used, evicted last
+            except OSError:
+                data = None
+            if data is not None:
+                with self.lock:
+                    self.disk_hits += 1
+                    self.bytes_served += len(data)
+                    self._remember(key, data)
+                return data
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, data):
+        with self.lock:
+            self.bytes_stored += len(data)
+            self._remember(key, data)
+        if self.directory is None:
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        with self.lock:
+            self.disk_size += len(data)
+            evict = self.disk_size > self.disk_bytes
+        if evict:
+            self._evict_disk()
+
+    def tee(self, key, chunks):
+        """
+        Passes the chunks through and stores the whole audio once the last one
+        went by. An interrupted stream is not cached.
+        """
+        data = bytearray()
+        for chunk in chunks:
+            data += chunk
+            yield chunk
+        if data:
+            self.put(key, bytes(data))
+
+    def _remember(self, key, data):
+        if len(data) > self.memory_bytes:
+            return
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.memory_size -= len(old)
+        self.memory[key] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+
+    def _disk_entries(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pcm"):
+                try:
+                    stat = entry.stat()
+                except OSError:  # removed by another session
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def _evict_disk(self):
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.disk_bytes * 0.9:  # some headroom so we do not rescan on every put
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        with self.lock:
+            self.disk_size = total
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else None,
+            "bytes_served": self.bytes_served,
+            "bytes_stored": self.bytes_stored,
+            "memory_bytes": self.memory_size,
+            "disk_bytes": self.disk_size,
+        }
@@ -0,0 +1,249 @@
+"""
+What is sent to Transcribe: encoding and silence suppression.
+
+Raw 16 kHz PCM is 256 kbit/s, silences included, for the whole session. Between
+the audio source and send_audio_event the blocks can be:
+
+- thinned out: past max_silence of quiet only one block every keepalive
+  seconds is sent, enough for Transcribe to finalize the results and keep the
+  stream open. The endpointer still sees every block, it runs before this.
+- compressed to FLAC (lossless, ~1/5 of the size on speech) or Ogg-Opus
+  (~1/20), the two compressed media encodings Transcribe streaming accepts.
+  Both go through libsndfile, with the soundfile package.
+
+The bytes in and out and the encoding CPU time are counted per session.
+"""
+
+import io
+import time
+
+import numpy as np
+
+from endpointing import FULL_SCALE_DB
+
+MEDIA_ENCODINGS = ("pcm", "flac", "ogg-opus")
+SFC_SET_OGG_PAGE_LATENCY_MS = 0x1302  # libsndfile >= 1.2.0
+
+
+class _StreamFile:
+    """
+    Write-only file for libsndfile that hands out the bytes as they are written.
+    Header updates at positions already sent, done on close, are dropped: the
+    streamed formats do not need them.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.sent = 0  # file offset of buffer[0]
+        self.position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        start, end = self.position, self.position + len(data)
+        self.position = end
+        if end <= self.sent:
+            return len(data)
+        if start < self.sent:
+            data, start = data[self.sent - start:], self.sent
+        offset = start - self.sent
+        if offset > len(self.buffer):
+            self.buffer += bytes(offset - len(self.buffer))
+        self.buffer[offset:offset + len(data)] = data
+        return end - start
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.sent + len(self.buffer)
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        return b""
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.sent += len(data)
+        self.buffer.clear()
+        return data
+
+
+class PcmEncoder:
+    media_encoding = "pcm"
+
+    def __init__(self, sample_rate=16000):
+        pass
+
+    def encode(self, block):
+        return block
+
+    def flush(self):
+        return b""
+
+
+def _set_ogg_page_latency(writer, milliseconds):
+    """
+    Asks libsndfile for short Ogg pages: by default a page holds about a second
+    of audio, which Transcribe would then get a second late.
+
+    soundfile has no public sf_command, this goes through its private _ffi, _snd
+    and SoundFile._file (checked with soundfile 0.14.0 and libsndfile 1.2.2) and
+    needs libsndfile 1.2.0 for the command itself. When either is missing the
+    pages keep their default length.
+
+    :return: Whether the page latency was set.
+    """
+    import soundfile
+
+    version = getattr(soundfile, "__libsndfile_version__", "0")
+    try:
+        if tuple(int(part) for part in version.split(".")[:2]) < (1, 2):
+            return False
+        latency = soundfile._ffi.new("double*", float(milliseconds))
+        soundfile._snd.sf_command(writer._file, SFC_SET_OGG_PAGE_LATENCY_MS, latency, soundfile._ffi.sizeof("double"))
+    except (AttributeError, TypeError, ValueError):
+        return False
+    return True
+
+
+class SoundFileEncoder:
+    """
+    Streams int16 blocks through libsndfile.
+
+    :param compression: 0 (fastest) to 1 (smallest), None for the library default.
+    :param page_latency: Milliseconds of audio per Ogg page, how long Opus holds
+                         the audio before sending it. See page_latency_set.
+    """
+
+    media_encoding = None
+    format = None
+    subtype = None
+
+    def __init__(self, sample_rate=16000, compression=None, page_latency=100):
+        import soundfile
+
+        self.file = _StreamFile()
+        self.writer = soundfile.SoundFile(self.file, "w", sample_rate, 1, self.subtype, format=self.format,
+                                          compression_level=compression)
+        self.page_latency_set = self.format == "OGG" and _set_ogg_page_latency(self.writer, page_latency)
+        if self.format == "OGG" and not self.page_latency_set:
+            print(f"[upstream]... could not set the Ogg page latency with libsndfile "
+                  f"{getattr(soundfile, '__libsndfile_version__', '?')}, the audio is sent about 1 s late")
+
+    def encode(self, block):
+        self.writer.write(np.frombuffer(block, dtype=np.int16))
+        return self.file.take()
+
+    def flush(self):
+        self.writer.close()
+        return self.file.take()
+
+
+class FlacEncoder(SoundFileEncoder):
+    media_encoding = "flac"
+    format = "FLAC"
+    subtype = "PCM_16"
+
+
+class OggOpusEncoder(SoundFileEncoder):
+    media_encoding = "ogg-opus"
+    format = "OGG"
+    subtype = "OPUS"
+
+
+ENCODERS = {"pcm": PcmEncoder, "flac": FlacEncoder, "ogg-opus": OggOpusEncoder}
+
+
+class SilenceSuppressor:
+    """
+    :param threshold_db: Blocks quieter than this are silence.
+    :param max_silence: Seconds of every silence that are still sent, Transcribe
+                        needs some to close its results.
+    :param keepalive: Seconds between the blocks sent during a long silence, under
+                      the 15 s after which Transcribe closes a stream without audio.
+    """
+
+    def __init__(self, sample_rate=16000, threshold_db=-50.0, max_silence=1.0, keepalive=5.0):
+        self.sample_rate = sample_rate
+        self.threshold_db = threshold_db
+        self.max_silence = max_silence
+        self.keepalive = keepalive
+        self.silence = 0.0
+        self.since_sent = 0.0
+
+    def keep(self, block):
+        """
+        :return: False if the block can be left out of the stream.
+        """
+        samples = np.frombuffer(block, dtype=np.int16).astype(np.float32)
+        duration = samples.size / self.sample_rate
+        if samples.size and 10 * np.log10(np.mean(samples * samples) + 1e-9) - FULL_SCALE_DB > self.threshold_db:
+            self.silence = 0.0
+        else:
+            self.silence += duration
+        if self.silence <= self.max_silence or self.since_sent + duration >= self.keepalive:
+            self.since_sent = 0.0
+            return True
+        self.since_sent += duration
+        return False
+
+
+class UpstreamAudio:
+    """
+    The encoding stage of one transcription stream.
+
+    :param encoding: "pcm", "flac" or "ogg-opus".
+    :param suppress_silence: Thin out the long silences.
+    """
+
+    def __init__(self, encoding="pcm", suppress_silence=False, sample_rate=16000):
+        if encoding not in MEDIA_ENCODINGS:
+            raise ValueError(f"encoding must be one of {MEDIA_ENCODINGS}, not {encoding!r}")
+        self.encoding = encoding
+        self.sample_rate = sample_rate
+        self.suppressor = SilenceSuppressor(sample_rate) if suppress_silence else None
+        self.encoder = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.blocks_dropped = 0
+        self.audio_seconds = 0.0
+        self.cpu_time = 0.0
+
+    def start(self):
+        # every connection is a new file for Transcribe, with its own header
+        self.encoder = ENCODERS[self.encoding](sample_rate=self.sample_rate)
+
+    def encode(self, block):
+        """
+        :return: The bytes to send for the block, possibly empty.
+        """
+        start = time.thread_time()
+        self.bytes_in += len(block)
+        self.audio_seconds += len(block) / 2 / self.sample_rate
+        data = b""
+        if self.suppressor is None or self.suppressor.keep(block):
+            data = self.encoder.encode(block)
+        else:
+            self.blocks_dropped += 1
+        self.bytes_out += len(data)
+        self.cpu_time += time.thread_time() - start
+        return data
+
+    def flush(self):
+        return self.encoder.flush() if self.encoder is not None else b""
+
+    def stats(self):
+        seconds = self.audio_seconds or None
+        return {
+            "encoding": self.encoding,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "kbit_per_s": self.bytes_out * 8 / 1000 / seconds if seconds else None,
+            "ratio": self.bytes_in / self.bytes_out if self.bytes_out else None,
+            "silent_blocks_dropped": self.blocks_dropped,
+            "cpu_per_audio_second": self.cpu_time / seconds if seconds else None,
+        }